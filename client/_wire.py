@@ -0,0 +1,28 @@
+"""
+Negociación de formato y decodificación de respuestas compartidas por los clientes
+"""
+import httpx
+
+try:
+    import orjson
+except ImportError:  # Se usa json estándar si orjson no está disponible
+    orjson = None
+
+try:
+    import brotli  # noqa: F401  (habilita la decodificación 'br' en httpx)
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+try:
+    import msgpack
+    ACCEPT = "application/msgpack, application/json;q=0.9"
+except ImportError:  # Sin msgpack solo se negocia JSON
+    msgpack = None
+    ACCEPT = "application/json"
+
+def decode_response(response: httpx.Response):
+    """Decodificar el cuerpo de la respuesta según su Content-Type"""
+    if msgpack is not None and response.headers.get("Content-Type", "").startswith("application/msgpack"):
+        return msgpack.unpackb(response.content, raw=False)
+    return orjson.loads(response.content) if orjson is not None else response.json()
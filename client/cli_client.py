@@ -2,13 +2,39 @@
 Cliente de línea de comandos para la API de optimización de portafolios
 """
 import argparse
-import requests
+import asyncio
+import functools
+import httpx
 import json
+import os
+import random
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
-from datetime import datetime
-import pandas as pd
+
+from _wire import ACCEPT, ACCEPT_ENCODING, decode_response, orjson
+
+try:
+    import diskcache
+except ImportError:  # Cache en disco opcional
+    diskcache = None
+
+# Cache local solo para análisis de portafolio (health y status siempre consultan al servidor)
+CACHE_DIR = os.path.expanduser("~/.portfolio_cli_cache")
+CACHE_TTL_SECONDS = 3600
+CACHEABLE_ENDPOINTS = {"/portfolio/analyze"}
+
+# Reintentos ante fallos transitorios (backoff exponencial con jitter). Un POST solo se
+# reintenta si el servidor no llegó a procesarlo: fallo de conexión o 502/503, nunca en
+# timeouts de lectura ni 504, que relanzarían un análisis de varios minutos
+MAX_RETRIES = 5
+IDEMPOTENT_METHODS = {"GET", "DELETE"}
+RETRY_STATUS_CODES = {502, 503, 504}
+POST_RETRY_STATUS_CODES = {502, 503}
+POST_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
 
 class PortfolioAPIClient:
     """Cliente para interactuar con la API de portafolios"""
@@ -16,33 +42,81 @@ class PortfolioAPIClient:
     def __init__(self, base_url: str = "http://localhost:8000"):
         self.base_url = base_url.rstrip("/")
         
+        # Cliente HTTP/2 reutilizable: una sola conexión multiplexa todas las peticiones
+        self._client = httpx.Client(
+            base_url=self.base_url,
+            http2=True,
+            timeout=httpx.Timeout(300.0, connect=5.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            headers={
+                "Accept": ACCEPT,
+                "Accept-Encoding": ACCEPT_ENCODING
+            }
+        )
+        # El cache en disco se abre en el primer análisis: --health y --status no lo pagan
+        self._cache = None
+        
+    def _send_with_retries(self, method: str, endpoint: str, data: dict = None) -> httpx.Response:
+        """Enviar petición reintentando fallos transitorios con backoff exponencial y jitter"""
+        idempotent = method in IDEMPOTENT_METHODS
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else POST_RETRY_STATUS_CODES
+        retry_errors = httpx.TransportError if idempotent else POST_RETRY_ERRORS
+        
+        for attempt in range(MAX_RETRIES):
+            try:
+                response = self._client.request(method, endpoint, json=data)
+                
+                # Los errores 4xx y las respuestas exitosas no se reintentan
+                if response.status_code not in retry_status_codes or attempt == MAX_RETRIES - 1:
+                    return response
+            except retry_errors:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+            
+            # t_i = Uniform(0, min(t_max, t_0 * 2^i))
+            time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+    
+    def _result_cache(self):
+        """Cache en disco de análisis, abierto en el primer uso (None sin diskcache)"""
+        if self._cache is None and diskcache is not None:
+            self._cache = diskcache.Cache(CACHE_DIR)
+        return self._cache
+    
     def _make_request(self, endpoint: str, method: str = "GET", data: dict = None) -> Dict:
         """Realizar petición HTTP a la API"""
-        url = f"{self.base_url}{endpoint}"
+        # Solo el análisis de portafolio se cachea, por sus parámetros
+        cache_key = None
+        if endpoint in CACHEABLE_ENDPOINTS and self._result_cache() is not None:
+            cache_key = f"{self.base_url}{endpoint}:{json.dumps(data, sort_keys=True)}"
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                return cached
         
         try:
-            if method == "GET":
-                response = requests.get(url, timeout=300)
-            elif method == "POST":
-                response = requests.post(url, json=data, timeout=300)
-            elif method == "DELETE":
-                response = requests.delete(url, timeout=300)
-            
+            response = self._send_with_retries(method, endpoint, data)
             response.raise_for_status()
-            return response.json()
+            body = decode_response(response)
+            
+            if cache_key is not None:
+                self._cache.set(cache_key, body, expire=CACHE_TTL_SECONDS)
+            return body
             
-        except requests.exceptions.Timeout:
+        except Exception as e:
+            return self._handle_error(e)
+    
+    def _handle_error(self, error: Exception) -> Dict:
+        """Clasificar un error de petición y devolver su descripción"""
+        if isinstance(error, httpx.TimeoutException):
             print("❌ Error: La petición tardó demasiado tiempo")
             return {"error": "timeout"}
-        except requests.exceptions.ConnectionError:
+        if isinstance(error, httpx.TransportError):
             print(f"❌ Error: No se puede conectar a {self.base_url}")
             return {"error": "connection_error"}
-        except requests.exceptions.HTTPError as e:
-            print(f"❌ Error HTTP {e.response.status_code}: {e.response.text}")
-            return {"error": f"http_error_{e.response.status_code}"}
-        except Exception as e:
-            print(f"❌ Error inesperado: {str(e)}")
-            return {"error": str(e)}
+        if isinstance(error, httpx.HTTPStatusError):
+            print(f"❌ Error HTTP {error.response.status_code}: {error.response.text}")
+            return {"error": f"http_error_{error.response.status_code}"}
+        print(f"❌ Error inesperado: {str(error)}")
+        return {"error": str(error)}
     
     def health_check(self) -> bool:
         """Verificar salud de la API"""
@@ -117,7 +191,50 @@ class PortfolioAPIClient:
         
         return result
     
-    def analyze_stocks(self, symbols: List[str], start_date: str, end_date: str) -> Dict:
+    async def analyze_stocks_async(self, symbols: List[str], start_date: str, end_date: str,
+                                   chunk_size: int = 20, concurrency: int = 8) -> Dict:
+        """Analizar stocks en lotes concurrentes y combinar las métricas"""
+        chunks = [symbols[i:i + chunk_size] for i in range(0, len(symbols), chunk_size)]
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def post_chunk(client: httpx.AsyncClient, chunk: List[str]) -> Dict:
+            payload = {"symbols": chunk, "start_date": start_date, "end_date": end_date}
+            async with semaphore:
+                response = await client.post("/stocks/analyze", json=payload)
+                response.raise_for_status()
+                return decode_response(response)
+        
+        async with httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=True,
+            timeout=httpx.Timeout(300.0, connect=5.0),
+            limits=httpx.Limits(max_connections=concurrency, keepalive_expiry=60)
+        ) as client:
+            responses = await asyncio.gather(
+                *[post_chunk(client, chunk) for chunk in chunks],
+                return_exceptions=True
+            )
+        
+        # Combinar métricas de los lotes exitosos
+        metrics = {}
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, Exception):
+                print(f"❌ Error en lote {', '.join(chunk[:3])}...: {str(response)}")
+                continue
+            metrics.update(response.get("metrics", {}))
+        
+        if not metrics:
+            return {"error": "batch_failed"}
+        
+        return {
+            "status": "success",
+            "stocks_analyzed": len(metrics),
+            "metrics": metrics,
+            "period": f"{start_date} to {end_date}"
+        }
+    
+    def analyze_stocks(self, symbols: List[str], start_date: str, end_date: str,
+                       chunk_size: int = 20) -> Dict:
         """Analizar stocks individuales"""
         print("📊 Iniciando análisis de stocks...")
         print(f"   Symbols: {', '.join(symbols)}")
@@ -130,7 +247,11 @@ class PortfolioAPIClient:
         }
         
         start_time = time.time()
-        result = self._make_request("/stocks/analyze", method="POST", data=data)
+        if len(symbols) > chunk_size:
+            # Listas grandes: lotes concurrentes para solapar red y cómputo del servidor
+            result = asyncio.run(self.analyze_stocks_async(symbols, start_date, end_date, chunk_size))
+        else:
+            result = self._make_request("/stocks/analyze", method="POST", data=data)
         end_time = time.time()
         
         if "error" in result:
@@ -141,23 +262,64 @@ class PortfolioAPIClient:
         
         # Mostrar resultados
         if result.get("status") == "success":
-            print(f"\n📊 ANÁLISIS DE {result['stocks_analyzed']} STOCKS")
-            print("=" * 70)
-            print(f"{'Stock':<8} {'Retorno':<12} {'Volatilidad':<12} {'Sharpe':<8} {'Datos':<6}")
-            print("-" * 70)
-            
-            for symbol, metrics in result["metrics"].items():
-                print(f"{symbol:<8} {metrics['total_return']:>10.2%} "
-                      f"{metrics['volatility']:>10.2%} {metrics['sharpe_ratio']:>6.3f} "
-                      f"{metrics['data_points']:>5}")
+            self._print_stock_metrics(result)
         
         return result
     
+    def _print_stock_metrics(self, result: Dict):
+        """Imprimir la tabla de métricas de un análisis de stocks en una sola escritura"""
+        print(f"\n📊 ANÁLISIS DE {result['stocks_analyzed']} STOCKS")
+        print("=" * 70)
+        lines = [
+            f"{'Stock':<8} {'Retorno':<12} {'Volatilidad':<12} {'Sharpe':<8} {'Datos':<6}",
+            "-" * 70
+        ]
+        lines.extend(
+            f"{symbol:<8} {metrics['total_return']:>10.2%} "
+            f"{metrics['volatility']:>10.2%} {metrics['sharpe_ratio']:>6.3f} "
+            f"{metrics['data_points']:>5}"
+            for symbol, metrics in result["metrics"].items()
+        )
+        print("\n".join(lines))
+    
+    def analyze_stocks_batch(self, jobs: List[Dict]) -> Dict:
+        """Analizar varios trabajos {symbols, start_date, end_date} en una sola petición"""
+        print(f"📦 Enviando lote de {len(jobs)} análisis de stocks...")
+        
+        # Sondeo silencioso: un 404/405 solo indica que el servidor no soporta lotes
+        try:
+            response = self._send_with_retries("POST", "/stocks/analyze/batch", {"jobs": jobs})
+            if response.status_code not in (404, 405):
+                response.raise_for_status()
+                return decode_response(response)
+        except Exception as e:
+            return self._handle_error(e)
+        
+        # Peticiones concurrentes sobre el mismo pool de conexiones; la salida se imprime
+        # después, desde el hilo principal, para no intercalar tablas
+        print("↪️  Endpoint de lotes no disponible, usando peticiones concurrentes")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(
+                lambda job: self._make_request("/stocks/analyze", method="POST", data=job),
+                jobs
+            ))
+        
+        for job, result in zip(jobs, results):
+            if result.get("status") == "success":
+                self._print_stock_metrics(result)
+            else:
+                print(f"❌ Error en {', '.join(job['symbols'][:3])}...: {result.get('error', 'unknown')}")
+        
+        return {"status": "success", "results": results}
+    
     def clear_cache(self) -> Dict:
         """Limpiar cache del sistema"""
         print("🧹 Limpiando cache...")
         result = self._make_request("/cache/clear", method="DELETE")
         
+        if self._result_cache() is not None:
+            self._cache.clear()
+        
         if "error" not in result:
             print(f"✅ {result.get('message', 'Cache limpiado')}")
         
@@ -166,14 +328,23 @@ class PortfolioAPIClient:
     def export_results(self, result: Dict, filename: str):
         """Exportar resultados a archivo JSON"""
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(result, f, indent=2, ensure_ascii=False, default=str)
+            if orjson is not None:
+                with open(filename, 'wb') as f:
+                    f.write(orjson.dumps(
+                        result,
+                        option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY,
+                        default=str
+                    ))
+            else:
+                with open(filename, 'w', encoding='utf-8') as f:
+                    json.dump(result, f, indent=2, ensure_ascii=False, default=str)
             print(f"📁 Resultados exportados a: {filename}")
         except Exception as e:
             print(f"❌ Error exportando resultados: {str(e)}")
 
-def main():
-    """Función principal del CLI"""
+@functools.cache
+def _build_parser() -> argparse.ArgumentParser:
+    """Construir el parser de argumentos (una sola vez por proceso)"""
     parser = argparse.ArgumentParser(
         description="Cliente CLI para Portfolio Optimization API",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -235,6 +406,11 @@ Ejemplos de uso:
     stocks_parser.add_argument("--end-date", default="2023-03-01",
                               help="Fecha de fin (YYYY-MM-DD)")
     
+    return parser
+
+def main():
+    """Función principal del CLI"""
+    parser = _build_parser()
     args = parser.parse_args()
     
     # Crear cliente
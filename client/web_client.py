@@ -2,13 +2,21 @@
 Cliente web para la API de optimización de portafolios
 """
 import streamlit as st
-import requests
+import asyncio
+import base64
+import httpx
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 import plotly.express as px
 from datetime import datetime, date
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Dict, List, Tuple
+
+from _wire import ACCEPT, ACCEPT_ENCODING, decode_response, orjson
 
 # Configuración de la página
 st.set_page_config(
@@ -24,46 +32,126 @@ except Exception:
     # Si no hay archivo de secretos, usar valor por defecto
     API_BASE_URL = "http://localhost:8000"
 
-def make_api_request(endpoint: str, method: str = "GET", data: dict = None):
-    """Realizar petición a la API"""
-    url = f"{API_BASE_URL}{endpoint}"
-    
-    try:
-        if method == "GET":
-            response = requests.get(url, timeout=300)
-        elif method == "POST":
-            response = requests.post(url, json=data, timeout=300)
-        elif method == "DELETE":
-            response = requests.delete(url, timeout=300)
-        
-        response.raise_for_status()
-        return response.json()
+@st.cache_resource
+def get_client() -> httpx.Client:
+    """Cliente HTTP/2 compartido entre reruns para reutilizar conexiones"""
+    # Con transporte explícito, HTTP/2 y los reintentos de conexión se configuran en él
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+    )
+    return httpx.Client(
+        base_url=API_BASE_URL,
+        transport=transport,
+        timeout=httpx.Timeout(300.0, connect=5.0),
+        headers={
+            "Accept": ACCEPT,
+            "Accept-Encoding": ACCEPT_ENCODING
+        }
+    )
+
+def _make_async_client() -> httpx.AsyncClient:
+    """Cliente asíncrono HTTP/2 para consultas en paralelo"""
+    # No se cachea con st.cache_resource: cada asyncio.run crea un event loop nuevo
+    # y las conexiones de un AsyncClient quedan ligadas al loop que las abrió
+    return httpx.AsyncClient(
+        base_url=API_BASE_URL,
+        http2=True,
+        timeout=httpx.Timeout(300.0, connect=5.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        headers={"Accept": ACCEPT, "Accept-Encoding": ACCEPT_ENCODING}
+    )
+
+async def _fetch_concurrently(endpoints: List[str]) -> List:
+    """Consultar varios endpoints GET en paralelo (None si alguno falla)"""
+    async with _make_async_client() as client:
+        responses = await asyncio.gather(
+            *[client.get(endpoint) for endpoint in endpoints],
+            return_exceptions=True
+        )
     
-    except requests.exceptions.Timeout:
+    return [
+        None if isinstance(response, Exception) or response.is_error else decode_response(response)
+        for response in responses
+    ]
+
+def _send_request(endpoint: str, method: str = "GET", data: dict = None):
+    """Enviar petición HTTP y devolver el JSON (propaga las excepciones)"""
+    response = get_client().request(method, endpoint, json=data)
+    response.raise_for_status()
+    return decode_response(response)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_portfolio_analysis(request_data: dict):
+    """Análisis de portafolio cacheado por parámetros de la petición"""
+    # Series de performance como deltas float32 (el servidor ignora el parámetro si no lo soporta)
+    return _send_request("/portfolio/analyze?encoding=delta-f32", method="POST", data=request_data)
+
+def clear_request_cache():
+    """Invalidar las respuestas cacheadas en el cliente"""
+    _cached_portfolio_analysis.clear()
+
+def _forget_last_result():
+    """Descartar el último resultado para no mostrarlo como éxito de otra ejecución"""
+    st.session_state.pop("last_result", None)
+    st.session_state.pop("last_request", None)
+
+def _show_request_error(error: Exception):
+    """Mostrar en la interfaz el error de una petición fallida"""
+    if isinstance(error, httpx.TimeoutException):
         st.error("⏱️ Timeout: La petición tardó demasiado tiempo")
-        return None
-    except requests.exceptions.ConnectionError:
+    elif isinstance(error, httpx.TransportError):
         st.error(f"🔌 Error de conexión: No se puede conectar a {API_BASE_URL}")
-        return None
-    except requests.exceptions.HTTPError as e:
-        st.error(f"❌ Error HTTP {e.response.status_code}: {e.response.text}")
-        return None
+    elif isinstance(error, httpx.HTTPStatusError):
+        st.error(f"❌ Error HTTP {error.response.status_code}: {error.response.text}")
+    else:
+        st.error(f"🚫 Error inesperado: {str(error)}")
+
+def make_api_request(endpoint: str, method: str = "GET", data: dict = None):
+    """Realizar petición a la API"""
+    try:
+        # health y status no se cachean: deben reflejar el estado actual del servidor
+        if method == "POST" and endpoint == "/portfolio/analyze":
+            return _cached_portfolio_analysis(data)
+        return _send_request(endpoint, method, data)
     except Exception as e:
-        st.error(f"🚫 Error inesperado: {str(e)}")
+        _show_request_error(e)
         return None
 
+def _get_executor() -> ThreadPoolExecutor:
+    """Pool de threads por sesión para ejecutar análisis en segundo plano"""
+    if "executor" not in st.session_state:
+        st.session_state["executor"] = ThreadPoolExecutor(max_workers=2)
+    return st.session_state["executor"]
+
+@st.cache_data(show_spinner=False)
+def _parse_dates(dates: List[str]) -> np.ndarray:
+    """Convertir fechas ISO a datetime64[ns] una sola vez por lista de fechas"""
+    # Formato explícito: evita la inferencia de formato en cada elemento
+    return pd.to_datetime(dates, format="%Y-%m-%d", cache=True).values
+
+def _decode_series(data: Dict, key: str) -> np.ndarray:
+    """Obtener una serie de performance, reconstruyéndola si llega como deltas float32"""
+    values = data[key]
+    if data.get("encoding") == "delta-f32":
+        deltas = np.frombuffer(base64.b64decode(values), dtype="<f4")
+        return np.cumsum(deltas, dtype=np.float64)
+    return np.asarray(values, dtype=np.float64)
+
 def plot_performance_comparison(data):
     """Graficar comparación de performance"""
-    dates = pd.to_datetime(data['dates'])
-    portfolio_returns = data['portfolio_cumulative_returns']
-    benchmark_returns = data['benchmark_cumulative_returns']
+    dates = _parse_dates(data['dates'])
+    # Conversión vectorizada a porcentaje (float32 basta para graficar)
+    portfolio_returns = _decode_series(data, 'portfolio_cumulative_returns').astype(np.float32) * 100.0
+    benchmark_returns = _decode_series(data, 'benchmark_cumulative_returns').astype(np.float32) * 100.0
     
     fig = go.Figure()
     
     # Línea del portafolio
     fig.add_trace(go.Scatter(
         x=dates,
-        y=[r * 100 for r in portfolio_returns],
+        y=portfolio_returns,
         mode='lines',
         name='Portafolio (Sentiment Strategy)',
         line=dict(color='#1f77b4', width=3)
@@ -72,7 +160,7 @@ def plot_performance_comparison(data):
     # Línea del benchmark
     fig.add_trace(go.Scatter(
         x=dates,
-        y=[r * 100 for r in benchmark_returns],
+        y=benchmark_returns,
         mode='lines',
         name='Benchmark (QQQ)',
         line=dict(color='#ff7f0e', width=2)
@@ -89,34 +177,44 @@ def plot_performance_comparison(data):
     
     return fig
 
+@st.cache_data(show_spinner=False)
+def _compute_composition_views(composition_data: Dict[str, List[str]]) -> Tuple[pd.Series, List[str]]:
+    """Calcular top stocks y últimas fechas de la composición (cacheado entre reruns)"""
+    # Crear DataFrame para análisis a partir de columnas
+    dates_col = list(chain.from_iterable([d] * len(s) for d, s in composition_data.items()))
+    stocks_col = list(chain.from_iterable(composition_data.values()))
+    comp_df = pd.DataFrame({"Fecha": dates_col, "Stock": stocks_col})
+    
+    # Contar frecuencia de stocks
+    stock_counts = comp_df['Stock'].value_counts()
+    return stock_counts.head(10), sorted(composition_data.keys())[-5:]
+
+@st.cache_data(show_spinner=False)
+def _compute_scatter_data(metrics: Dict[str, Dict]) -> Tuple[List[float], List[float], List[str]]:
+    """Extraer volatilidad y retorno por stock para el gráfico (cacheado entre reruns)"""
+    volatilities = [m['volatility'] for m in metrics.values()]
+    returns = [m['total_return'] for m in metrics.values()]
+    return volatilities, returns, list(metrics.keys())
+
 def show_portfolio_composition(composition_data):
     """Mostrar composición del portafolio"""
     if not composition_data:
         st.warning("No hay datos de composición disponibles")
         return
     
-    # Crear DataFrame para análisis
-    comp_list = []
-    for date, stocks in composition_data.items():
-        for stock in stocks:
-            comp_list.append({"Fecha": date, "Stock": stock})
+    top_stocks, last_dates = _compute_composition_views(composition_data)
     
-    if comp_list:
-        comp_df = pd.DataFrame(comp_list)
-        
-        # Contar frecuencia de stocks
-        stock_counts = comp_df['Stock'].value_counts()
-        
+    if not top_stocks.empty:
         col1, col2 = st.columns(2)
         
         with col1:
             st.subheader("🏆 Stocks más frecuentes")
-            for i, (stock, count) in enumerate(stock_counts.head(10).items()):
+            for i, (stock, count) in enumerate(top_stocks.items()):
                 st.write(f"{i+1}. **{stock}**: {count} meses")
         
         with col2:
             st.subheader("📅 Composición por fecha")
-            for date in sorted(composition_data.keys())[-5:]:  # Últimas 5 fechas
+            for date in last_dates:  # Últimas 5 fechas
                 stocks = composition_data[date]
                 st.write(f"**{date}**: {', '.join(stocks[:3])}{'...' if len(stocks) > 3 else ''}")
 
@@ -141,6 +239,17 @@ def main():
                 else:
                     st.error("❌ API no disponible")
         
+        if st.button("🔄 Refrescar Dashboard"):
+            with st.spinner("Consultando health y status..."):
+                health_data, status_data = asyncio.run(_fetch_concurrently(["/health", "/status"]))
+            if health_data:
+                st.success("✅ API en línea")
+                st.json(health_data)
+            else:
+                st.error("❌ API no disponible")
+            if status_data:
+                st.json(status_data)
+        
         if st.button("Estado Detallado"):
             status_data = make_api_request("/status")
             if status_data:
@@ -148,6 +257,7 @@ def main():
         
         if st.button("Limpiar Cache"):
             result = make_api_request("/cache/clear", method="DELETE")
+            clear_request_cache()
             if result:
                 st.success(result.get("message", "Cache limpiado"))
     
@@ -175,76 +285,108 @@ def main():
             
             submitted = st.form_submit_button("🚀 Ejecutar Análisis", type="primary")
         
+        # Datos de la petición según el formulario actual
+        request_data = {
+            "sentiment_url": sentiment_url,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "top_n_stocks": top_n_stocks,
+            "benchmark_ticker": benchmark_ticker
+        }
+        
         if submitted:
-            # Preparar datos de la petición
-            request_data = {
-                "sentiment_url": sentiment_url,
-                "start_date": start_date.strftime("%Y-%m-%d"),
-                "end_date": end_date.strftime("%Y-%m-%d"),
-                "top_n_stocks": top_n_stocks,
-                "benchmark_ticker": benchmark_ticker
-            }
-            
-            # Mostrar progress bar
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            status_text.text("Enviando petición a la API...")
-            progress_bar.progress(10)
-            
-            # Realizar petición
-            with st.spinner("Procesando análisis (esto puede tomar varios minutos)..."):
-                start_time = time.time()
-                result = make_api_request("/portfolio/analyze", method="POST", data=request_data)
-                end_time = time.time()
-                
-                progress_bar.progress(100)
-                status_text.text(f"Completado en {end_time - start_time:.2f} segundos")
+            # Reutilizar el último resultado si los parámetros no cambiaron
+            if request_data != st.session_state.get("last_request") or not st.session_state.get("last_result"):
+                _forget_last_result()
+                # Ejecutar en segundo plano para que la interfaz siga respondiendo
+                st.session_state["portfolio_job"] = {
+                    "request": request_data,
+                    "future": _get_executor().submit(_cached_portfolio_analysis, request_data),
+                    "started_at": time.time()
+                }
+        
+        job = st.session_state.get("portfolio_job")
+        if job is not None:
+            future = job["future"]
             
-            if result and result.get("status") == "success":
-                st.success("✅ Análisis completado exitosamente!")
-                
-                # Mostrar métricas principales
-                analysis = result["analysis"]
+            if st.button("⏹️ Cancelar análisis"):
+                # Si la petición ya está en curso, su resultado simplemente se descarta
+                future.cancel()
+                del st.session_state["portfolio_job"]
+                _forget_last_result()
+                st.warning("⚠️ Análisis cancelado")
+            else:
+                progress_bar = st.progress(0)
+                status_text = st.empty()
+                status_text.text("Procesando análisis (esto puede tomar varios minutos)...")
                 
-                col1, col2, col3, col4 = st.columns(4)
-                with col1:
-                    st.metric(
-                        "Retorno Total Portafolio",
-                        f"{analysis['total_portfolio_return']:.2%}",
-                        delta=f"{analysis['excess_return']:.2%}"
-                    )
-                with col2:
-                    st.metric(
-                        "Retorno Benchmark",
-                        f"{analysis['total_benchmark_return']:.2%}"
-                    )
-                with col3:
-                    st.metric(
-                        "Volatilidad Portafolio",
-                        f"{analysis['portfolio_volatility']:.2%}"
-                    )
-                with col4:
-                    st.metric(
-                        "Sharpe Ratio",
-                        f"{analysis['sharpe_ratio']:.3f}"
-                    )
+                while not future.done():
+                    elapsed = time.time() - job["started_at"]
+                    progress_bar.progress(min(95, 10 + int(elapsed)))
+                    time.sleep(0.5)
                 
-                # Gráfico de performance
-                st.subheader("📈 Performance Comparativa")
-                fig = plot_performance_comparison(result["performance_data"])
-                st.plotly_chart(fig, use_container_width=True)
+                progress_bar.progress(100)
+                status_text.text(f"Completado en {time.time() - job['started_at']:.2f} segundos")
+                del st.session_state["portfolio_job"]
                 
-                # Composición del portafolio
-                st.subheader("📋 Composición del Portafolio")
-                show_portfolio_composition(result["portfolio_composition"])
+                try:
+                    result = future.result()
+                except Exception as e:
+                    _show_request_error(e)
+                    result = None
                 
-                # Detalles técnicos
-                with st.expander("🔍 Detalles Técnicos"):
-                    st.json(result["metadata"])
+                if result and result.get("status") == "success":
+                    st.session_state["last_request"] = job["request"]
+                    st.session_state["last_result"] = result
+                else:
+                    _forget_last_result()
+                    if result:
+                        st.error(f"❌ Error en el análisis: {result}")
+        
+        # Solo se muestra el resultado que corresponde a los parámetros actuales
+        result = st.session_state.get("last_result")
+        if (result and "portfolio_job" not in st.session_state
+                and st.session_state.get("last_request") == request_data):
+            st.success("✅ Análisis completado exitosamente!")
             
-            elif result:
-                st.error(f"❌ Error en el análisis: {result}")
+            # Mostrar métricas principales
+            analysis = result["analysis"]
+            
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric(
+                    "Retorno Total Portafolio",
+                    f"{analysis['total_portfolio_return']:.2%}",
+                    delta=f"{analysis['excess_return']:.2%}"
+                )
+            with col2:
+                st.metric(
+                    "Retorno Benchmark",
+                    f"{analysis['total_benchmark_return']:.2%}"
+                )
+            with col3:
+                st.metric(
+                    "Volatilidad Portafolio",
+                    f"{analysis['portfolio_volatility']:.2%}"
+                )
+            with col4:
+                st.metric(
+                    "Sharpe Ratio",
+                    f"{analysis['sharpe_ratio']:.3f}"
+                )
+            
+            # Gráfico de performance
+            st.subheader("📈 Performance Comparativa")
+            fig = plot_performance_comparison(result["performance_data"])
+            st.plotly_chart(fig, use_container_width=True)
+            
+            # Composición del portafolio
+            st.subheader("📋 Composición del Portafolio")
+            show_portfolio_composition(result["portfolio_composition"])
+            
+            # Detalles técnicos
+            with st.expander("🔍 Detalles Técnicos"):
+                st.json(result["metadata"])
     
     with tab2:
         st.header("Análisis Individual de Stocks")
@@ -270,8 +412,8 @@ def main():
             if symbols:
                 request_data = {
                     "symbols": symbols,
-                    "start_date": stock_start_date.strftime("%Y-%m-%d"),
-                    "end_date": stock_end_date.strftime("%Y-%m-%d")
+                    "start_date": stock_start_date.isoformat(),
+                    "end_date": stock_end_date.isoformat()
                 }
                 
                 with st.spinner("Analizando stocks..."):
@@ -280,26 +422,25 @@ def main():
                 if result and result.get("status") == "success":
                     st.success(f"✅ Análisis completado para {result['stocks_analyzed']} stocks")
                     
-                    # Crear DataFrame con métricas
-                    metrics_data = []
-                    for symbol, metrics in result["metrics"].items():
-                        metrics_data.append({
-                            "Stock": symbol,
-                            "Retorno Total": f"{metrics['total_return']:.2%}",
-                            "Volatilidad": f"{metrics['volatility']:.2%}",
-                            "Sharpe Ratio": f"{metrics['sharpe_ratio']:.3f}",
-                            "Datos": metrics['data_points']
+                    # Crear DataFrame con métricas (formateo por columna)
+                    metrics_df = pd.DataFrame.from_dict(result["metrics"], orient="index")
+                    if not metrics_df.empty:
+                        df = pd.DataFrame({
+                            "Stock": metrics_df.index,
+                            "Retorno Total": metrics_df["total_return"].map("{:.2%}".format).to_numpy(),
+                            "Volatilidad": metrics_df["volatility"].map("{:.2%}".format).to_numpy(),
+                            "Sharpe Ratio": metrics_df["sharpe_ratio"].map("{:.3f}".format).to_numpy(),
+                            "Datos": metrics_df["data_points"].to_numpy()
                         })
-                    
-                    df = pd.DataFrame(metrics_data)
-                    st.dataframe(df, use_container_width=True)
+                        st.dataframe(df, use_container_width=True)
                     
                     # Gráfico de retorno vs volatilidad
                     if len(result["metrics"]) > 1:
+                        volatilities, returns, labels = _compute_scatter_data(result["metrics"])
                         fig = px.scatter(
-                            x=[m['volatility'] for m in result["metrics"].values()],
-                            y=[m['total_return'] for m in result["metrics"].values()],
-                            text=list(result["metrics"].keys()),
+                            x=volatilities,
+                            y=returns,
+                            text=labels,
                             labels={"x": "Volatilidad", "y": "Retorno Total"},
                             title="Retorno vs Volatilidad"
                         )
@@ -349,12 +490,18 @@ def main():
         # Test de conectividad
         if st.button("🧪 Test de Conectividad"):
             with st.spinner("Probando conexión..."):
-                root_data = make_api_request("/")
-                if root_data:
-                    st.success("✅ Conexión exitosa")
-                    st.json(root_data)
-                else:
-                    st.error("❌ Error de conexión")
+                root_data, health_data, status_data = asyncio.run(
+                    _fetch_concurrently(["/", "/health", "/status"])
+                )
+            if root_data:
+                st.success("✅ Conexión exitosa")
+                st.json(root_data)
+                if health_data:
+                    st.json(health_data)
+                if status_data:
+                    st.json(status_data)
+            else:
+                st.error("❌ Error de conexión")
 
 if __name__ == "__main__":
     main()
@@ -7,17 +7,26 @@ import os
 import asyncio
 import time
 import logging
+import orjson
+from collections import Counter
+from heapq import nlargest
+from itertools import chain
 
 # Agregar src al path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
 from data_processor import ParallelPortfolioEngine, shutdown_ray
+from metrics import compute_metrics
+from yahoo import filter_tickers
 import ray
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# PORTFOLIO_DEBUG=1 escribe el JSON de resultados indentado
+DEBUG = os.environ.get("PORTFOLIO_DEBUG") == "1"
+
 async def run_portfolio_analysis():
     """Ejecutar análisis completo del portafolio"""
     
@@ -26,14 +35,21 @@ async def run_portfolio_analysis():
     start_date = "2021-01-01"
     end_date = "2023-03-01"
     top_n_stocks = 5
+    benchmark_task = None
     
     try:
         logger.info("🚀 Iniciando Portfolio Optimization con Ray")
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         # Crear motor de portfolio
         engine = ParallelPortfolioEngine(batch_size=15)
         
+        # El benchmark no depende del sentiment: descargarlo en un hilo mientras tanto
+        logger.info("📊 Obteniendo datos de benchmark (QQQ) en segundo plano...")
+        benchmark_task = asyncio.create_task(
+            asyncio.to_thread(engine.get_benchmark_data, "QQQ", start_date, end_date)
+        )
+        
         # Procesar datos de sentiment
         logger.info("📊 Procesando datos de sentiment...")
         portfolio_dates = await engine.process_sentiment_data(sentiment_url)
@@ -45,10 +61,10 @@ async def run_portfolio_analysis():
         logger.info(f"✅ Datos de sentiment procesados. {len(portfolio_dates)} períodos encontrados")
         
         # Obtener stocks únicos
-        all_stocks = []
-        for stocks in portfolio_dates.values():
-            all_stocks.extend(stocks)
-        unique_stocks = list(set(all_stocks))
+        unique_stocks = list({s for stocks in portfolio_dates.values() for s in stocks})
+        
+        # Excluir stocks problemáticos o con formato inválido
+        unique_stocks = filter_tickers(unique_stocks)
         
         logger.info(f"📈 Descargando datos para {len(unique_stocks)} stocks únicos...")
         
@@ -69,36 +85,26 @@ async def run_portfolio_analysis():
             prices_df, portfolio_dates
         )
         
-        # Obtener datos de benchmark
-        logger.info("📊 Obteniendo datos de benchmark (QQQ)...")
-        benchmark_data = engine.get_benchmark_data("QQQ", start_date, end_date)
-        
-        # Combinar con benchmark
-        combined_performance = portfolio_performance.merge(
-            benchmark_data, left_index=True, right_index=True, how='left'
-        )
-        
         # Calcular métricas finales
         logger.info("📈 Calculando métricas de performance...")
         
-        portfolio_returns = combined_performance['portfolio_return'].dropna()
-        benchmark_returns = combined_performance['qqq_return'].dropna()
-        
-        # Retornos acumulativos
-        import numpy as np
-        portfolio_cumulative = np.exp(np.log1p(portfolio_returns).cumsum()).sub(1)
-        benchmark_cumulative = np.exp(np.log1p(benchmark_returns).cumsum()).sub(1)
+        portfolio_returns = portfolio_performance['portfolio_return'].dropna()
         
-        # Métricas
-        total_portfolio_return = portfolio_cumulative.iloc[-1] if len(portfolio_cumulative) > 0 else 0
-        total_benchmark_return = benchmark_cumulative.iloc[-1] if len(benchmark_cumulative) > 0 else 0
+        if portfolio_returns.empty:
+            logger.error("❌ No hay retornos del portafolio en el rango de fechas")
+            return
         
-        portfolio_volatility = portfolio_returns.std() * np.sqrt(252)
-        benchmark_volatility = benchmark_returns.std() * np.sqrt(252)
+        benchmark_data = await benchmark_task
+        benchmark_returns = (
+            benchmark_data['qqq_return'].reindex(portfolio_performance.index).dropna()
+        )
         
-        sharpe_ratio = (portfolio_returns.mean() * 252) / portfolio_volatility if portfolio_volatility > 0 else 0
+        (portfolio_cumulative, total_portfolio_return,
+         portfolio_volatility, sharpe_ratio) = compute_metrics(portfolio_returns.to_numpy())
+        (benchmark_cumulative, total_benchmark_return,
+         benchmark_volatility, _) = compute_metrics(benchmark_returns.to_numpy())
         
-        processing_time = time.time() - start_time
+        processing_time = time.perf_counter() - start_time
         
         # Mostrar resultados
         logger.info("🎉 ¡Análisis completado exitosamente!")
@@ -118,23 +124,18 @@ async def run_portfolio_analysis():
         
         # Mostrar algunos de los top stocks más frecuentes
         print("\n🏆 TOP STOCKS MÁS FRECUENTES:")
-        stock_frequency = {}
-        for stocks in portfolio_dates.values():
-            for stock in stocks:
-                stock_frequency[stock] = stock_frequency.get(stock, 0) + 1
-        
-        top_stocks = sorted(stock_frequency.items(), key=lambda x: x[1], reverse=True)[:10]
+        stock_frequency = Counter(chain.from_iterable(portfolio_dates.values()))
+        top_stocks = stock_frequency.most_common(10)
         for i, (stock, freq) in enumerate(top_stocks, 1):
             print(f"{i:2d}. {stock}: {freq} meses")
         
         # Mostrar últimas composiciones
         print(f"\n📅 ÚLTIMAS 5 COMPOSICIONES DE PORTFOLIO:")
-        for date in sorted(portfolio_dates.keys())[-5:]:
+        for date in sorted(nlargest(5, portfolio_dates.keys())):
             stocks = portfolio_dates[date]
             print(f"{date}: {', '.join(stocks)}")
         
         # Guardar resultados en archivo
-        import json
         results = {
             "analysis": {
                 "total_portfolio_return": float(total_portfolio_return),
@@ -150,14 +151,19 @@ async def run_portfolio_analysis():
             "portfolio_composition": portfolio_dates,
             "top_stocks": dict(top_stocks),
             "performance_data": {
-                "dates": portfolio_cumulative.index.strftime('%Y-%m-%d').tolist(),
-                "portfolio_cumulative_returns": portfolio_cumulative.values.tolist(),
-                "benchmark_cumulative_returns": benchmark_cumulative.values.tolist()
+                "dates": portfolio_returns.index.strftime('%Y-%m-%d').tolist(),
+                "portfolio_cumulative_returns": portfolio_cumulative,
+                "benchmark_cumulative_returns": benchmark_cumulative
             }
         }
         
-        with open('portfolio_results.json', 'w') as f:
-            json.dump(results, f, indent=2, default=str)
+        # orjson serializa los arrays NumPy directamente, sin listas intermedias de floats;
+        # JSON compacto salvo en modo debug
+        options = orjson.OPT_SERIALIZE_NUMPY
+        if DEBUG:
+            options |= orjson.OPT_INDENT_2
+        with open('portfolio_results.json', 'wb') as f:
+            f.write(orjson.dumps(results, option=options, default=str))
         
         logger.info("💾 Resultados guardados en 'portfolio_results.json'")
         
@@ -167,6 +173,11 @@ async def run_portfolio_analysis():
         logger.error(f"❌ Error en el análisis: {str(e)}")
         raise
     finally:
+        # Los retornos anticipados no esperan al benchmark: terminar el hilo y recoger
+        # su posible excepción antes de apagar Ray
+        if benchmark_task is not None:
+            await asyncio.gather(benchmark_task, return_exceptions=True)
+        
         # Limpiar Ray
         shutdown_ray()
         logger.info("🧹 Ray desconectado")
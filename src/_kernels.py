@@ -0,0 +1,62 @@
+"""
+Kernels numéricos para los retornos del portafolio (numba si está disponible)
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # Sin numba se usa la versión vectorizada con NumPy
+    njit = None
+    prange = range
+
+def log_diff(prices: np.ndarray) -> np.ndarray:
+    """Log-retornos por fila (n-1 filas): un np.log y una resta escrita en un buffer preasignado"""
+    # Sin al menos dos precios no hay retornos (p. ej. ticker inválido con descarga vacía)
+    if prices.shape[0] < 2:
+        return np.empty((0,) + prices.shape[1:])
+    log_prices = np.log(prices)
+    returns = np.empty((log_prices.shape[0] - 1,) + log_prices.shape[1:])
+    np.subtract(log_prices[1:], log_prices[:-1], out=returns)
+    return returns
+
+def _log_diff_monthly_mean_loop(prices: np.ndarray, month_id: np.ndarray,
+                                col_in_month: np.ndarray) -> np.ndarray:
+    """Log-retorno diario y media sobre los stocks del mes en una sola pasada por fila"""
+    n_rows, n_cols = prices.shape
+    out = np.empty(n_rows)
+    out[0] = np.nan
+    for i in prange(1, n_rows):
+        m = month_id[i]
+        total = 0.0
+        count = 0
+        valid = True
+        for j in range(n_cols):
+            # Un solo log por elemento: log(p_i / p_{i-1}) en lugar de dos logs y una resta
+            r = np.log(prices[i, j] / prices[i - 1, j])
+            # Un NaN en cualquier columna descarta la fila, igual que dropna() sobre los retornos
+            if np.isnan(r):
+                valid = False
+                break
+            if col_in_month[m, j]:
+                total += r
+                count += 1
+        out[i] = total / count if valid and count > 0 else np.nan
+    return out
+
+def _log_diff_monthly_mean_numpy(prices: np.ndarray, month_id: np.ndarray,
+                                 col_in_month: np.ndarray) -> np.ndarray:
+    """Equivalente vectorizado de _log_diff_monthly_mean_loop"""
+    log_prices = np.log(prices)
+    returns = log_prices[1:] - log_prices[:-1]
+    mask = col_in_month[month_id[1:]]
+    
+    counts = mask.sum(axis=1)
+    totals = np.where(mask, returns, 0.0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = totals / counts
+    means[np.isnan(returns).any(axis=1)] = np.nan
+    return np.concatenate(([np.nan], means))
+
+# Sin fastmath: el kernel depende de np.isnan para replicar dropna()
+log_diff_monthly_mean = (njit(parallel=True, cache=True)(_log_diff_monthly_mean_loop)
+                         if njit is not None else _log_diff_monthly_mean_numpy)
@@ -3,28 +3,37 @@ API principal usando FastAPI con Ray Serve para servir el modelo de portafolio
 """
 import ray
 from ray import serve
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import APIRouter, FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
 import pandas as pd
 import numpy as np
 import asyncio
 import json
 import logging
+from collections import OrderedDict
 from typing import Dict, List, Optional
 from pydantic import BaseModel
 from datetime import datetime
 import os
 import sys
+import time
 
 # Agregar el directorio src al path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
 from data_processor import ParallelPortfolioEngine
+from metrics import SQRT_TRADING_DAYS, TRADING_DAYS, compute_metrics
+from wire_format import apply_encoding
+from yahoo import filter_tickers
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Máximo de resultados de portafolio en cache por réplica
+MAX_CACHE_ENTRIES = 64
+
 # Modelos Pydantic para requests
 class PortfolioRequest(BaseModel):
     sentiment_url: str = "https://raw.githubusercontent.com/SalomeAc/Infraestructuras-proyecto/refs/heads/main/sentiment_data.csv"
@@ -42,7 +51,8 @@ class StockAnalysisRequest(BaseModel):
 app = FastAPI(
     title="Portfolio Optimization API with Ray",
     description="API para optimización de portafolios usando sentiment analysis y Ray",
-    version="2.0.0-ray"
+    version="2.0.0-ray",
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS
@@ -54,6 +64,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Comprimir respuestas grandes (performance_data) cuando el cliente lo acepta
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# Endpoints sin estado de réplica: funciones de módulo en un router, sin enlazar self
+router = APIRouter()
+
+@router.get("/")
+async def root():
+    """Endpoint raíz"""
+    return {
+        "message": "Portfolio Optimization API with Ray",
+        "version": "2.0.0-ray",
+        "engine": "Ray Serve",
+        "endpoints": {
+            "portfolio": "/portfolio/analyze",
+            "stocks": "/stocks/analyze", 
+            "health": "/health",
+            "status": "/status"
+        }
+    }
+
+app.include_router(router)
+
 @serve.deployment(num_replicas=1, ray_actor_options={"num_cpus": 2})
 @serve.ingress(app)
 class PortfolioAPI:
@@ -61,30 +94,27 @@ class PortfolioAPI:
     
     def __init__(self):
         self.engine = ParallelPortfolioEngine(batch_size=15)
-        self.cache = {}
+        # Cache LRU acotado: cada entrada guarda series completas de performance
+        self.cache = OrderedDict()
+        # Timestamp ISO del health check, regenerado como máximo una vez por segundo
+        self._health_iso = ""
+        self._health_iso_at = 0.0
         logger.info("PortfolioAPI con Ray inicializada")
     
-    @app.get("/")
-    def root(self):
-        """Endpoint raíz"""
-        return {
-            "message": "Portfolio Optimization API with Ray",
-            "version": "2.0.0-ray",
-            "engine": "Ray Serve",
-            "endpoints": {
-                "portfolio": "/portfolio/analyze",
-                "stocks": "/stocks/analyze", 
-                "health": "/health",
-                "status": "/status"
-            }
-        }
+    def _health_timestamp(self) -> str:
+        """Timestamp ISO cacheado para endpoints consultados con alta frecuencia (probes)"""
+        now = time.monotonic()
+        if now - self._health_iso_at >= 1.0:
+            self._health_iso = datetime.now().isoformat()
+            self._health_iso_at = now
+        return self._health_iso
     
     @app.get("/health")
-    def health_check(self):
+    async def health_check(self):
         """Health check endpoint"""
         return {
             "status": "healthy",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": self._health_timestamp(),
             "version": "ray-enabled",
             "ray_initialized": ray.is_initialized(),
             "cache_size": len(self.cache)
@@ -112,37 +142,50 @@ class PortfolioAPI:
         }
     
     @app.post("/portfolio/analyze")
-    def analyze_portfolio(self, request: PortfolioRequest):
+    async def analyze_portfolio(self, request: PortfolioRequest, encoding: Optional[str] = None):
         """Analizar portafolio basado en sentiment analysis"""
         try:
-            logger.info(f"Iniciando análisis de portafolio: {request.dict()}")
+            # Serializar el request una sola vez (log, cache y metadata)
+            params = request.model_dump()
+            logger.info(f"Iniciando análisis de portafolio: {params}")
             
-            # Crear clave de cache
-            cache_key = f"portfolio_{hash(str(request.dict()))}"
+            # Clave de cache estructural (no depende del orden del dict ni de str())
+            cache_key = (
+                request.sentiment_url,
+                request.start_date,
+                request.end_date,
+                request.top_n_stocks,
+                request.benchmark_ticker
+            )
             
             # Verificar cache
             if cache_key in self.cache:
                 logger.info("Resultado obtenido del cache")
-                return self.cache[cache_key]
+                self.cache.move_to_end(cache_key)
+                # Respuesta explícita: jsonable_encoder no admite los arrays NumPy del resultado
+                return ORJSONResponse(apply_encoding(self.cache[cache_key], encoding))
+            
+            start_time = time.perf_counter()
             
-            start_time = datetime.now()
+            loop = asyncio.get_running_loop()
             
-            # Procesar datos de sentimiento (sin async)
-            portfolio_dates = self.engine.process_sentiment_data_sync(request.sentiment_url)
+            # Procesar datos de sentimiento esperando los ObjectRef de Ray sin bloquear el event loop
+            portfolio_dates = await self.engine.process_sentiment_data(request.sentiment_url)
             
             if not portfolio_dates:
                 raise HTTPException(status_code=400, detail="No se pudieron procesar datos de sentimiento")
             
             # Obtener lista de stocks únicos
-            all_stocks = []
-            for stocks in portfolio_dates.values():
-                all_stocks.extend(stocks)
-            unique_stocks = list(set(all_stocks))
+            unique_stocks = list({s for stocks in portfolio_dates.values() for s in stocks})
+            
+            # Excluir stocks problemáticos o con formato inválido (solo los derivados del sentiment)
+            unique_stocks = filter_tickers(unique_stocks)
             
             logger.info(f"Analizando {len(unique_stocks)} stocks únicos")
             
-            # Descargar datos de acciones en paralelo
-            prices_df = self.engine.download_stock_data_parallel(
+            # Descargar datos de acciones en paralelo (trabajo bloqueante fuera del event loop)
+            prices_df = await loop.run_in_executor(
+                None, self.engine.download_stock_data_parallel,
                 unique_stocks, request.start_date, request.end_date
             )
             
@@ -150,38 +193,34 @@ class PortfolioAPI:
                 raise HTTPException(status_code=500, detail="No se pudieron descargar datos de acciones")
             
             # Calcular performance del portafolio
-            portfolio_performance = self.engine.calculate_portfolio_performance(
+            portfolio_performance = await loop.run_in_executor(
+                None, self.engine.calculate_portfolio_performance,
                 prices_df, portfolio_dates
             )
             
             # Obtener datos de benchmark
-            benchmark_data = self.engine.get_benchmark_data(
+            benchmark_data = await loop.run_in_executor(
+                None, self.engine.get_benchmark_data,
                 request.benchmark_ticker, request.start_date, request.end_date
             )
             
-            # Combinar con benchmark
-            combined_performance = portfolio_performance.merge(
-                benchmark_data, left_index=True, right_index=True, how='left'
-            )
-            
             # Calcular métricas de performance
-            portfolio_returns = combined_performance['portfolio_return'].dropna()
-            benchmark_returns = combined_performance[f'{request.benchmark_ticker.lower()}_return'].dropna()
+            portfolio_returns = portfolio_performance['portfolio_return'].dropna()
             
-            # Retornos acumulativos
-            portfolio_cumulative = np.exp(np.log1p(portfolio_returns).cumsum()).sub(1)
-            benchmark_cumulative = np.exp(np.log1p(benchmark_returns).cumsum()).sub(1)
+            if portfolio_returns.empty:
+                raise HTTPException(status_code=400, detail="No hay retornos del portafolio en el rango de fechas")
             
-            # Métricas
-            total_portfolio_return = portfolio_cumulative.iloc[-1] if len(portfolio_cumulative) > 0 else 0
-            total_benchmark_return = benchmark_cumulative.iloc[-1] if len(benchmark_cumulative) > 0 else 0
-            
-            portfolio_volatility = portfolio_returns.std() * np.sqrt(252)
-            benchmark_volatility = benchmark_returns.std() * np.sqrt(252)
+            benchmark_returns = (
+                benchmark_data[f'{request.benchmark_ticker.lower()}_return']
+                .reindex(portfolio_performance.index).dropna()
+            )
             
-            sharpe_ratio = (portfolio_returns.mean() * 252) / portfolio_volatility if portfolio_volatility > 0 else 0
+            (portfolio_cumulative, total_portfolio_return,
+             portfolio_volatility, sharpe_ratio) = compute_metrics(portfolio_returns.to_numpy())
+            (benchmark_cumulative, total_benchmark_return,
+             benchmark_volatility, _) = compute_metrics(benchmark_returns.to_numpy())
             
-            processing_time = (datetime.now() - start_time).total_seconds()
+            processing_time = time.perf_counter() - start_time
             
             result = {
                 "status": "success",
@@ -197,35 +236,41 @@ class PortfolioAPI:
                     "unique_stocks_analyzed": len(unique_stocks)
                 },
                 "performance_data": {
-                    "dates": portfolio_cumulative.index.strftime('%Y-%m-%d').tolist(),
-                    "portfolio_cumulative_returns": portfolio_cumulative.values.tolist(),
-                    "benchmark_cumulative_returns": benchmark_cumulative.values.tolist()
+                    "dates": portfolio_returns.index.strftime('%Y-%m-%d').tolist(),
+                    "portfolio_cumulative_returns": portfolio_cumulative,
+                    "benchmark_cumulative_returns": benchmark_cumulative
                 },
                 "portfolio_composition": portfolio_dates,
                 "metadata": {
-                    "request_params": request.dict(),
+                    "request_params": params,
                     "timestamp": datetime.now().isoformat()
                 }
             }
             
-            # Guardar en cache
+            # Guardar en cache, descartando la entrada menos usada si se excede el límite
             self.cache[cache_key] = result
+            if len(self.cache) > MAX_CACHE_ENTRIES:
+                self.cache.popitem(last=False)
             
             logger.info(f"Análisis completado en {processing_time:.2f} segundos")
-            return result
+            return ORJSONResponse(apply_encoding(result, encoding))
             
+        except HTTPException:
+            # Errores de validación propios: conservar su status code
+            raise
         except Exception as e:
             logger.error(f"Error en análisis de portafolio: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
     
     @app.post("/stocks/analyze")
-    def analyze_stocks(self, request: StockAnalysisRequest):
+    async def analyze_stocks(self, request: StockAnalysisRequest):
         """Analizar stocks individuales"""
         try:
             logger.info(f"Analizando stocks: {request.symbols}")
             
-            # Descargar datos
-            prices_df = self.engine.download_stock_data_parallel(
+            # Descargar datos fuera del event loop
+            prices_df = await asyncio.get_running_loop().run_in_executor(
+                None, self.engine.download_stock_data_parallel,
                 request.symbols, request.start_date, request.end_date
             )
             
@@ -233,31 +278,44 @@ class PortfolioAPI:
                 raise HTTPException(status_code=500, detail="No se pudieron descargar datos")
             
             # Procesar retornos
-            if isinstance(prices_df.columns, pd.MultiIndex):
-                if 'Adj Close' in prices_df.columns.get_level_values(0):
-                    adj_close = prices_df.xs('Adj Close', axis=1, level=0)
-                else:
-                    adj_close = prices_df.xs('Adj Close', axis=1, level=1)
+            # Selección directa por el primer nivel (caso habitual de yfinance) sin pasar por xs
+            if 'Adj Close' in prices_df.columns:
+                adj_close = prices_df['Adj Close']
+            elif isinstance(prices_df.columns, pd.MultiIndex):
+                adj_close = prices_df.xs('Adj Close', axis=1, level=1)
             else:
-                adj_close = prices_df['Adj Close'] if 'Adj Close' in prices_df.columns else prices_df
-            
-            returns = np.log(adj_close).diff().dropna()
-            
-            # Calcular métricas por stock
-            stock_metrics = {}
-            for symbol in returns.columns:
-                stock_returns = returns[symbol].dropna()
-                if len(stock_returns) > 0:
-                    total_return = np.exp(stock_returns.sum()) - 1
-                    volatility = stock_returns.std() * np.sqrt(252)
-                    sharpe = (stock_returns.mean() * 252) / volatility if volatility > 0 else 0
-                    
-                    stock_metrics[symbol] = {
-                        "total_return": float(total_return),
-                        "volatility": float(volatility),
-                        "sharpe_ratio": float(sharpe),
-                        "data_points": len(stock_returns)
-                    }
+                adj_close = prices_df
+            
+            # Un solo ticker con columnas planas devuelve una Series
+            if isinstance(adj_close, pd.Series):
+                adj_close = adj_close.to_frame(request.symbols[0])
+            
+            # Log-retornos con un único divide vectorizado sobre el ndarray
+            vals = adj_close.to_numpy(dtype=np.float64)
+            returns = pd.DataFrame(
+                np.log(vals[1:] / vals[:-1]),
+                index=adj_close.index[1:],
+                columns=adj_close.columns
+            ).dropna()
+            
+            # Métricas por stock vectorizadas sobre todas las columnas a la vez
+            data_points = returns.count().to_numpy()
+            total_return = np.exp(returns.sum().to_numpy()) - 1
+            volatility = returns.std().to_numpy() * SQRT_TRADING_DAYS
+            annual_mean = returns.mean().to_numpy() * TRADING_DAYS
+            sharpe = np.divide(annual_mean, volatility, out=np.zeros_like(volatility),
+                               where=volatility > 0)
+            
+            stock_metrics = {
+                symbol: {
+                    "total_return": float(total_return[i]),
+                    "volatility": float(volatility[i]),
+                    "sharpe_ratio": float(sharpe[i]),
+                    "data_points": int(data_points[i])
+                }
+                for i, symbol in enumerate(returns.columns)
+                if data_points[i] > 0
+            }
             
             return {
                 "status": "success",
@@ -276,6 +334,7 @@ class PortfolioAPI:
         """Limpiar cache"""
         cache_size = len(self.cache)
         self.cache.clear()
+        self.engine.clear_caches()
         return {
             "status": "success",
             "message": f"Cache limpiado. {cache_size} entradas eliminadas.",
@@ -314,7 +373,6 @@ if __name__ == "__main__":
         
         # Mantener el servidor corriendo
         import signal
-        import time
         
         def signal_handler(sig, frame):
             logger.info("Deteniendo Ray Serve...")
@@ -3,15 +3,38 @@ API simplificada sin Ray para compatibilidad con Windows/Python 3.13
 """
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 import pandas as pd
 import numpy as np
 import yfinance as yf
-from typing import Dict, List
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 from datetime import datetime
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import hashlib
+import json
+import pickle
 import time
+import os
+import sys
+
+# Agregar el directorio src al path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+from _kernels import log_diff
+from membership import portfolio_returns_from_prices
+from metrics import compute_metrics
+from wire_format import apply_encoding
+from yahoo import CHART_URL, SESSION, chart_params, filter_tickers, parse_chart
+
+try:
+    import diskcache
+except ImportError:  # Sin diskcache el cache de resultados queda en memoria del proceso
+    diskcache = None
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -34,7 +57,8 @@ class StockAnalysisRequest(BaseModel):
 app = FastAPI(
     title="Portfolio Optimization API (Sin Ray)",
     description="API para optimización de portafolios usando sentiment analysis",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS
@@ -46,11 +70,266 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Cache simple
-cache = {}
+# Comprimir respuestas grandes (performance_data) cuando el cliente lo acepta
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+# Límite de sockets simultáneos por sesión (acota también la concurrencia de chart)
+HTTP_CONNECTOR_LIMIT = 50
+
+# Presupuesto de memoria para los frames intermedios de sentiment
+STAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Las etapas no sobreviven al resultado: un recálculo tras expirar no reutiliza datos viejos
+STAGE_CACHE_TTL_SECONDS = 3600
+
+# Cache de resultados: expiración común; límites de entradas y bytes del fallback en memoria
+RESULT_CACHE_MAX_ENTRIES = 64
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_TTL_SECONDS = 3600
+
+# Cache de resultados en disco, compartido por todos los workers de uvicorn
+RESULT_CACHE_DIR = os.environ.get("PORTFOLIO_RESULT_CACHE_DIR", ".portfolio_results")
+RESULT_CACHE_SIZE_LIMIT = 2 ** 30
+
+# Copia en disco (CSV, nunca pickle) del sentiment parseado para que procesos nuevos no
+# repitan la descarga; directorio privado de la aplicación, no el tempdir compartido
+SENTIMENT_DISK_DIR = os.environ.get("PORTFOLIO_SENTIMENT_DIR", os.path.join(".portfolio_cache", "sentiment"))
+SENTIMENT_DISK_TTL_SECONDS = 24 * 3600
+
+class CostAwareCache:
+    """Cache acotado por bytes (y opcionalmente entradas y TTL) que desaloja la entrada
+    con menor costo de recomputo por byte"""
+    
+    def __init__(self, max_bytes: int, max_entries: Optional[int] = None,
+                 ttl_seconds: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # clave -> (valor, segundos de cómputo, bytes, expiración en tiempo Unix)
+        self._entries = {}
+    
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry[2]
+        return entry
+    
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is not None and entry[3] is not None and entry[3] < time.time():
+            self._pop(key)
+            entry = None
+        
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[0]
+    
+    def set(self, key, value, cost_seconds: float, size_bytes: int):
+        if key in self._entries:
+            self._pop(key)
+        expires_at = time.time() + self.ttl_seconds if self.ttl_seconds is not None else None
+        self._entries[key] = (value, cost_seconds, size_bytes, expires_at)
+        self.total_bytes += size_bytes
+        
+        # WRECIPROCAL: sale primero lo barato de recalcular y grande en memoria
+        while len(self._entries) > 1 and (
+            self.total_bytes > self.max_bytes
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            self._pop(min(self._entries, key=lambda k: self._entries[k][1] / max(self._entries[k][2], 1)))
+    
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+    
+    def stats(self) -> Dict:
+        """Contadores para ajustar los límites en producción"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+def _open_result_cache():
+    """Cache de resultados: diskcache si está disponible, si no CostAwareCache en memoria"""
+    if diskcache is not None:
+        result_cache = diskcache.Cache(RESULT_CACHE_DIR, size_limit=RESULT_CACHE_SIZE_LIMIT)
+        result_cache.stats(enable=True)
+        return result_cache
+    return CostAwareCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_ENTRIES,
+                          RESULT_CACHE_TTL_SECONDS)
+
+cache = _open_result_cache()
+
+# Un lock por clave en cómputo: las peticiones idénticas concurrentes calculan una sola vez
+_compute_locks: Dict[str, asyncio.Lock] = {}
+
+def _store_result(key: str, result: Dict):
+    """Guardar un resultado con su TTL (y costo y tamaño en el cache en memoria)"""
+    if diskcache is not None:
+        cache.set(key, result, expire=RESULT_CACHE_TTL_SECONDS)
+    else:
+        cache.set(key, result, result["processing_time_seconds"],
+                  len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)))
+
+def _result_cache_stats() -> Dict:
+    """Estadísticas del cache de resultados con el mismo formato en ambos backends"""
+    if diskcache is None:
+        return cache.stats()
+    hits, misses = cache.stats()
+    lookups = hits + misses
+    return {
+        "entries": len(cache),
+        "total_bytes": cache.volume(),
+        "max_bytes": RESULT_CACHE_SIZE_LIMIT,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0
+    }
+
+# Resultados intermedios del pipeline (sentiment, composición, precios) por etapa
+stage_store = CostAwareCache(STAGE_CACHE_MAX_BYTES, ttl_seconds=STAGE_CACHE_TTL_SECONDS)
+
+def _frame_size(df: pd.DataFrame) -> int:
+    """Tamaño en memoria de un DataFrame en bytes"""
+    return int(df.memory_usage(deep=True).sum())
+
+def _stage_size(value) -> int:
+    """Tamaño aproximado de un resultado de etapa en bytes"""
+    return _frame_size(value) if isinstance(value, pd.DataFrame) else sys.getsizeof(value)
+
+def stage_cache(key_fn, cache_if=None):
+    """Memoizar una etapa (sync o async) en stage_store con la clave (etapa, *key_fn(args))
+    
+    Los resultados vacíos (descargas fallidas) no se guardan, ni los que no cumplan
+    cache_if(valor, *args) cuando se indica.
+    """
+    def decorator(func):
+        def _store(key, value, start, args):
+            is_empty = value.empty if isinstance(value, pd.DataFrame) else not value
+            if not is_empty and (cache_if is None or cache_if(value, *args)):
+                stage_store.set(key, value, time.perf_counter() - start, _stage_size(value))
+        
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args):
+                key = (func.__name__,) + key_fn(*args)
+                value = stage_store.get(key)
+                if value is None:
+                    start = time.perf_counter()
+                    value = await func(*args)
+                    _store(key, value, start, args)
+                return value
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__,) + key_fn(*args)
+            value = stage_store.get(key)
+            if value is None:
+                start = time.perf_counter()
+                value = func(*args)
+                _store(key, value, start, args)
+            return value
+        return wrapper
+    return decorator
+
+def _sentiment_disk_path(url: str) -> str:
+    """Ruta del CSV de sentiment asociado a una URL, en un directorio solo del usuario (0700)"""
+    os.makedirs(SENTIMENT_DISK_DIR, mode=0o700, exist_ok=True)
+    os.chmod(SENTIMENT_DISK_DIR, 0o700)
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(SENTIMENT_DISK_DIR, f"sentiment_{digest}.csv")
+
+def _clear_sentiment_disk():
+    """Borrar las copias en disco del sentiment"""
+    if not os.path.isdir(SENTIMENT_DISK_DIR):
+        return
+    for name in os.listdir(SENTIMENT_DISK_DIR):
+        if name.startswith("sentiment_"):
+            try:
+                os.remove(os.path.join(SENTIMENT_DISK_DIR, name))
+            except OSError as e:
+                logger.error(f"No se pudo borrar {name}: {e}")
+
+@stage_cache(lambda url: (url,))
+def load_sentiment_frame(url: str) -> pd.DataFrame:
+    """Cargar el CSV de sentiment filtrado por engagement, usando cache en memoria y disco"""
+    path = _sentiment_disk_path(url)
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < SENTIMENT_DISK_TTL_SECONDS:
+        logger.info("Datos de sentiment obtenidos del cache en disco")
+        sentiment_df = pd.read_csv(path, parse_dates=['date'], index_col=['date', 'symbol'])
+    else:
+        logger.info("Cargando datos de sentiment...")
+        sentiment_df = pd.read_csv(url)
+        sentiment_df['date'] = pd.to_datetime(sentiment_df['date'])
+        sentiment_df = sentiment_df.set_index(['date', 'symbol'])
+        
+        # Filtro de engagement y ratio en una pasada sobre los arrays: solo se divide lo que sobrevive
+        likes = sentiment_df['twitterLikes'].to_numpy()
+        comments = sentiment_df['twitterComments'].to_numpy()
+        mask = (likes > 20) & (comments > 10)
+        engagement = np.divide(comments[mask], likes[mask], dtype=np.float64)
+        sentiment_df = sentiment_df.loc[mask].assign(engagement_ratio=engagement)
+        
+        # Escritura atómica para no dejar archivos truncados a otros procesos
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        sentiment_df.to_csv(tmp_path)
+        os.replace(tmp_path, path)
+    
+    return sentiment_df
+
+@stage_cache(lambda url: (url,))
+def aggregate_sentiment(url: str) -> pd.DataFrame:
+    """Engagement medio y ranking por mes y símbolo (independiente de top_n y benchmark)"""
+    sentiment_df = load_sentiment_frame(url)
+    
+    # Agregar por mes (periodo mensual, sin depender del alias 'M'/'ME' de la versión de pandas)
+    months = sentiment_df.index.get_level_values('date').to_period('M')
+    aggregated_df = sentiment_df.groupby([months, 'symbol'])[['engagement_ratio']].mean()
+    
+    # Ranking por mes vectorizado (Cython), sin lambda por grupo
+    aggregated_df['rank'] = (aggregated_df.groupby(level=0)['engagement_ratio']
+                           .rank(ascending=False))
+    
+    return aggregated_df
+
+@stage_cache(lambda url, top_n: (url, top_n))
+def select_portfolio_dates(url: str, top_n: int) -> Dict[str, List[str]]:
+    """Top N stocks por engagement de cada mes, indexados por fecha de inicio del portafolio"""
+    aggregated_df = aggregate_sentiment(url)
+    
+    # Filtrar top N stocks
+    filtered_df = aggregated_df[aggregated_df['rank'] < (top_n + 1)].copy()
+    filtered_df = filtered_df.reset_index(level=1)
+    # El portafolio de cada mes se aplica desde el primer día del mes siguiente
+    filtered_df.index = (filtered_df.index + 1).to_timestamp()
+    filtered_df = filtered_df.reset_index().set_index(['date', 'symbol'])
+    
+    # Crear diccionario de fechas en una sola pasada (sin xs por fecha)
+    portfolio_dates = {
+        d.strftime('%Y-%m-%d'): grp.index.get_level_values('symbol').tolist()
+        for d, grp in filtered_df.groupby(level=0, sort=False)
+    }
+    
+    return portfolio_dates
 
 def download_stock_batch_simple(tickers: List[str], start_date: str, end_date: str) -> pd.DataFrame:
-    """Función para descargar un lote de acciones (versión sin Ray)"""
+    """Función para descargar un lote de acciones (versión sin Ray, solo Adj Close)"""
     try:
         logger.info(f"Descargando lote: {tickers[:3]}... ({len(tickers)} tickers)")
         data = yf.download(
@@ -58,40 +337,149 @@ def download_stock_batch_simple(tickers: List[str], start_date: str, end_date: s
             start=start_date, 
             end=end_date,
             auto_adjust=False, 
-            progress=False
+            progress=False,
+            session=SESSION
         )
-        return data
+        if data.empty:
+            return data
+        
+        # Devolver solo Adj Close (símbolos como columnas); un solo ticker devuelve una Series
+        adj_close = _extract_adj_close(data)
+        return adj_close.to_frame(tickers[0]) if isinstance(adj_close, pd.Series) else adj_close
     except Exception as e:
         logger.error(f"Error descargando lote {tickers}: {str(e)}")
         return pd.DataFrame()
 
 def parallel_stock_download_simple(stocks_list: List[str], start_date: str, end_date: str, batch_size: int = 15) -> pd.DataFrame:
-    """Descarga datos de acciones en paralelo usando ThreadPoolExecutor"""
+    """Descarga Adj Close en paralelo usando ThreadPoolExecutor (un símbolo por columna)"""
     
     # Dividir la lista en lotes
     batches = [stocks_list[i:i + batch_size] for i in range(0, len(stocks_list), batch_size)]
     
-    # Crear pool de threads para paralelización
-    with ThreadPoolExecutor(max_workers=4) as executor:
+    # Crear pool de threads para paralelización (descargas limitadas por red, no por CPU)
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(batches)))) as executor:
         futures = {executor.submit(download_stock_batch_simple, batch, start_date, end_date): batch 
                   for batch in batches}
         
+        # Procesar cada lote en orden de llegada: uno lento no retiene a los ya terminados
         results = []
-        for future in futures:
+        for future in as_completed(futures):
             try:
-                result = future.result()
-                if not result.empty:
-                    results.append(result)
+                adj_close = future.result()
+                if not adj_close.empty:
+                    results.append(adj_close)
             except Exception as e:
                 logger.error(f"Error en lote: {e}")
     
-    # Combinar resultados válidos
-    if results:
-        combined_df = pd.concat(results, axis=1)
-        logger.info(f"Descarga completada. Forma final: {combined_df.shape}")
-        return combined_df
-    else:
+    if not results:
         return pd.DataFrame()
+    
+    # Ensamblar en un ndarray preasignado en lugar de pd.concat sobre frames MultiIndex:
+    # índice común de días (normalmente idéntico entre lotes) y una columna por símbolo
+    index = results[0].index
+    for adj_close in results[1:]:
+        if not adj_close.index.equals(index):
+            index = index.union(adj_close.index)
+    
+    symbols = [symbol for adj_close in results for symbol in adj_close.columns]
+    col_of = {symbol: j for j, symbol in enumerate(symbols)}
+    values = np.full((len(index), len(symbols)), np.nan, dtype=np.float64)
+    for adj_close in results:
+        if not adj_close.index.equals(index):
+            adj_close = adj_close.reindex(index)
+        values[:, [col_of[symbol] for symbol in adj_close.columns]] = adj_close.to_numpy(dtype=np.float64)
+    
+    combined_df = pd.DataFrame(values, index=index, columns=symbols)
+    logger.info(f"Descarga completada. Forma final: {combined_df.shape}")
+    return combined_df
+
+def _extract_adj_close(prices_df: pd.DataFrame) -> pd.DataFrame:
+    """Extraer Adj Close (símbolos como columnas) de un frame de yf.download"""
+    if isinstance(prices_df.columns, pd.MultiIndex):
+        if 'Adj Close' in prices_df.columns.get_level_values(0):
+            return prices_df.xs('Adj Close', axis=1, level=0)
+        return prices_df.xs('Adj Close', axis=1, level=1)
+    return prices_df['Adj Close'] if 'Adj Close' in prices_df.columns else prices_df
+
+async def _fetch_chart(session: aiohttp.ClientSession, symbol: str,
+                       start_date: str, end_date: str) -> Optional[pd.Series]:
+    """Descargar el Adj Close diario de un símbolo desde el endpoint chart de Yahoo"""
+    try:
+        async with session.get(CHART_URL.format(symbol=symbol),
+                               params=chart_params(start_date, end_date)) as response:
+            response.raise_for_status()
+            return parse_chart(await response.json(), symbol)
+    except Exception as e:
+        logger.error(f"Error descargando {symbol}: {str(e)}")
+        return None
+
+async def fetch_adj_close(session: aiohttp.ClientSession, symbols: List[str],
+                          start_date: str, end_date: str) -> pd.DataFrame:
+    """Descargar todos los símbolos concurrentemente, un request de chart por símbolo"""
+    series = await asyncio.gather(*[
+        _fetch_chart(session, symbol, start_date, end_date) for symbol in symbols
+    ])
+    valid = [s for s in series if s is not None]
+    return pd.concat(valid, axis=1) if valid else pd.DataFrame()
+
+def _has_all_symbols(prices_df: pd.DataFrame, session, symbols: List[str], start_date: str, end_date: str) -> bool:
+    """Descarga completa: ningún símbolo pedido quedó sin datos"""
+    return prices_df.columns.intersection(symbols).size == len(set(symbols))
+
+@stage_cache(lambda session, symbols, start_date, end_date: (tuple(sorted(symbols)), start_date, end_date),
+             cache_if=_has_all_symbols)
+async def download_prices(session: aiohttp.ClientSession, symbols: List[str],
+                          start_date: str, end_date: str) -> pd.DataFrame:
+    """Adj Close de los símbolos vía chart, con yfinance en un hilo para los que falten"""
+    adj_close_df = await fetch_adj_close(session, symbols, start_date, end_date)
+    
+    missing = [s for s in symbols if s not in adj_close_df.columns]
+    if missing:
+        logger.info(f"Reintentando {len(missing)} stocks con yfinance...")
+        fallback_df = await asyncio.to_thread(
+            parallel_stock_download_simple, missing, start_date, end_date
+        )
+        if not fallback_df.empty:
+            adj_close_df = pd.concat([adj_close_df, fallback_df], axis=1)
+    
+    return adj_close_df
+
+@stage_cache(lambda session, ticker, start_date, end_date: (ticker, start_date, end_date))
+async def download_benchmark_returns(session: aiohttp.ClientSession, ticker: str,
+                                     start_date: str, end_date: str) -> pd.DataFrame:
+    """Log-retornos diarios del benchmark (chart, con yfinance en un hilo si falla)"""
+    benchmark_adj_close = await _fetch_chart(session, ticker, start_date, end_date)
+    if benchmark_adj_close is None:
+        benchmark_data = await asyncio.to_thread(
+            yf.download,
+            tickers=ticker,
+            start=start_date,
+            end=end_date,
+            auto_adjust=False,
+            session=SESSION
+        )
+        benchmark_adj_close = benchmark_data['Adj Close']
+    if isinstance(benchmark_adj_close, pd.DataFrame):
+        benchmark_adj_close = benchmark_adj_close.iloc[:, 0]
+    
+    return pd.DataFrame(
+        {f'{ticker.lower()}_return': log_diff(benchmark_adj_close.to_numpy(dtype=np.float64))},
+        index=benchmark_adj_close.index[1:]
+    )
+
+@app.on_event("startup")
+async def open_http_session():
+    """Crear la sesión HTTP compartida para las descargas de precios"""
+    app.state.http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=HTTP_CONNECTOR_LIMIT),
+        timeout=aiohttp.ClientTimeout(total=30),
+        headers={"User-Agent": "Mozilla/5.0"}
+    )
+
+@app.on_event("shutdown")
+async def close_http_session():
+    """Cerrar la sesión HTTP compartida"""
+    await app.state.http_session.close()
 
 @app.get("/")
 async def root():
@@ -125,175 +513,136 @@ async def get_status():
         "api_version": "simplified_no_ray",
         "cache_entries": len(cache),
         "timestamp": datetime.now().isoformat(),
-        "parallelization": "ThreadPoolExecutor"
+        "parallelization": "asyncio + aiohttp"
+    }
+
+async def compute_portfolio_analysis(request: PortfolioRequest, params: Dict) -> Dict:
+    """Pipeline completo de análisis de portafolio (sin cache de resultados)"""
+    start_time = time.time()
+    
+    # Composición mensual del portafolio (etapas cacheadas por URL y top N)
+    portfolio_dates = select_portfolio_dates(request.sentiment_url, request.top_n_stocks)
+    
+    # Obtener stocks únicos
+    unique_stocks = list({s for stocks in portfolio_dates.values() for s in stocks})
+    
+    # Excluir stocks problemáticos o con formato inválido
+    unique_stocks = filter_tickers(unique_stocks)
+    
+    logger.info(f"Descargando datos para {len(unique_stocks)} stocks...")
+    
+    # Descargar stocks y benchmark concurrentemente sin bloquear el event loop
+    session = app.state.http_session
+    adj_close_df, benchmark_returns = await asyncio.gather(
+        download_prices(session, unique_stocks, request.start_date, request.end_date),
+        download_benchmark_returns(session, request.benchmark_ticker,
+                                   request.start_date, request.end_date)
+    )
+    
+    if adj_close_df.empty:
+        raise HTTPException(status_code=500, detail="No se pudieron descargar datos de acciones")
+    
+    # Log-retornos y media mensual del portafolio en un solo kernel sobre los precios
+    portfolio_df = portfolio_returns_from_prices(adj_close_df, portfolio_dates)
+    
+    # Calcular métricas de performance
+    portfolio_returns = portfolio_df['portfolio_return'].dropna()
+    benchmark_rets = (
+        benchmark_returns[f'{request.benchmark_ticker.lower()}_return']
+        .reindex(portfolio_df.index).dropna()
+    )
+    
+    (portfolio_cumulative, total_portfolio_return,
+     portfolio_volatility, sharpe_ratio) = compute_metrics(portfolio_returns.to_numpy())
+    (benchmark_cumulative, total_benchmark_return,
+     benchmark_volatility, _) = compute_metrics(benchmark_rets.to_numpy())
+    
+    processing_time = time.time() - start_time
+    
+    result = {
+        "status": "success",
+        "processing_time_seconds": processing_time,
+        "analysis": {
+            "total_portfolio_return": float(total_portfolio_return),
+            "total_benchmark_return": float(total_benchmark_return),
+            "excess_return": float(total_portfolio_return - total_benchmark_return),
+            "portfolio_volatility": float(portfolio_volatility),
+            "benchmark_volatility": float(benchmark_volatility),
+            "sharpe_ratio": float(sharpe_ratio),
+            "number_of_periods": len(portfolio_dates),
+            "unique_stocks_analyzed": len(unique_stocks)
+        },
+        "performance_data": {
+            "dates": portfolio_returns.index.strftime('%Y-%m-%d').tolist(),
+            # ndarrays sin .tolist(): orjson los serializa directamente en C
+            "portfolio_cumulative_returns": portfolio_cumulative,
+            "benchmark_cumulative_returns": benchmark_cumulative
+        },
+        "portfolio_composition": portfolio_dates,
+        "metadata": {
+            "request_params": params,
+            "timestamp": datetime.now().isoformat(),
+            "api_version": "simplified_no_ray"
+        }
     }
+    
+    logger.info(f"Análisis completado en {processing_time:.2f} segundos")
+    return result
 
 @app.post("/portfolio/analyze")
-async def analyze_portfolio(request: PortfolioRequest):
+async def analyze_portfolio(request: PortfolioRequest, encoding: Optional[str] = None):
     """Analizar portafolio basado en sentiment analysis"""
     try:
-        logger.info(f"Iniciando análisis de portafolio: {request.dict()}")
+        # Serializar el request una sola vez (log, cache y metadata)
+        params = request.model_dump()
+        logger.info(f"Iniciando análisis de portafolio: {params}")
         
-        # Crear clave de cache
-        cache_key = f"portfolio_{hash(str(request.dict()))}"
+        # Clave de cache estable entre procesos: digest de la codificación JSON canónica
+        payload = json.dumps(params, sort_keys=True, separators=(",", ":")).encode()
+        cache_key = "portfolio_" + hashlib.blake2b(payload, digest_size=16).hexdigest()
         
         # Verificar cache
-        if cache_key in cache:
+        cached = cache.get(cache_key)
+        if cached is not None:
             logger.info("Resultado obtenido del cache")
-            return cache[cache_key]
+            return ORJSONResponse(apply_encoding(cached, encoding))
         
-        start_time = time.time()
-        
-        # Cargar datos de sentiment
-        logger.info("Cargando datos de sentiment...")
-        sentiment_df = pd.read_csv(request.sentiment_url)
-        sentiment_df['date'] = pd.to_datetime(sentiment_df['date'])
-        sentiment_df = sentiment_df.set_index(['date', 'symbol'])
-        sentiment_df['engagement_ratio'] = sentiment_df['twitterComments'] / sentiment_df['twitterLikes']
-        sentiment_df = sentiment_df[(sentiment_df['twitterLikes'] > 20) & (sentiment_df['twitterComments'] > 10)]
+        # Un solo cómputo por clave: las peticiones idénticas concurrentes esperan y leen del cache
+        lock = _compute_locks.setdefault(cache_key, asyncio.Lock())
+        async with lock:
+            # Re-chequeo sin contar un segundo fallo en las estadísticas: `in` no las toca
+            result = cache.get(cache_key) if cache_key in cache else None
+            if result is None:
+                try:
+                    result = await compute_portfolio_analysis(request, params)
+                    _store_result(cache_key, result)
+                finally:
+                    if _compute_locks.get(cache_key) is lock:
+                        del _compute_locks[cache_key]
         
-        # Agregar por mes
-        aggregated_df = (sentiment_df.reset_index('symbol')
-                        .groupby([pd.Grouper(freq='ME'), 'symbol'])  # Usar 'ME' en lugar de 'M'
-                        [['engagement_ratio']].mean())
-        
-        aggregated_df['rank'] = (aggregated_df.groupby(level=0)['engagement_ratio']
-                               .transform(lambda x: x.rank(ascending=False)))
-        
-        # Filtrar top N stocks
-        filtered_df = aggregated_df[aggregated_df['rank'] < (request.top_n_stocks + 1)].copy()
-        filtered_df = filtered_df.reset_index(level=1)
-        filtered_df.index = filtered_df.index + pd.DateOffset(1)
-        filtered_df = filtered_df.reset_index().set_index(['date', 'symbol'])
-        
-        # Crear diccionario de fechas
-        dates = filtered_df.index.get_level_values('date').unique().tolist()
-        portfolio_dates = {}
-        for d in dates:
-            portfolio_dates[d.strftime('%Y-%m-%d')] = filtered_df.xs(d, level=0).index.tolist()
-        
-        # Obtener stocks únicos
-        all_stocks = []
-        for stocks in portfolio_dates.values():
-            all_stocks.extend(stocks)
-        unique_stocks = list(set(all_stocks))
-        
-        # Excluir stocks problemáticos
-        excluded = ['MRO', 'ATVI']
-        unique_stocks = [s for s in unique_stocks if s not in excluded]
-        
-        logger.info(f"Descargando datos para {len(unique_stocks)} stocks...")
-        
-        # Descargar datos de stocks
-        prices_df = parallel_stock_download_simple(unique_stocks, request.start_date, request.end_date)
-        
-        if prices_df.empty:
-            raise HTTPException(status_code=500, detail="No se pudieron descargar datos de acciones")
-        
-        # Procesar retornos
-        if isinstance(prices_df.columns, pd.MultiIndex):
-            if 'Adj Close' in prices_df.columns.get_level_values(0):
-                adj_close_df = prices_df.xs('Adj Close', axis=1, level=0)
-            else:
-                adj_close_df = prices_df.xs('Adj Close', axis=1, level=1)
-        else:
-            adj_close_df = prices_df['Adj Close'] if 'Adj Close' in prices_df.columns else prices_df
-        
-        returns_df = np.log(adj_close_df).diff().dropna()
-        
-        # Calcular retornos del portafolio
-        portfolio_df = pd.DataFrame()
-        for start_date in portfolio_dates.keys():
-            end_date = (pd.to_datetime(start_date) + pd.offsets.MonthEnd()).strftime('%Y-%m-%d')
-            cols = portfolio_dates[start_date]
-            valid_cols = [c for c in cols if c in returns_df.columns]
-            
-            if valid_cols:
-                temp_df = returns_df.loc[start_date:end_date, valid_cols].mean(axis=1).to_frame('portfolio_return')
-                portfolio_df = pd.concat([portfolio_df, temp_df])
-        
-        # Obtener datos de benchmark
-        benchmark_data = yf.download(
-            tickers=request.benchmark_ticker,
-            start=request.start_date,
-            end=request.end_date,
-            auto_adjust=False
-        )
-        
-        if isinstance(benchmark_data.columns, pd.MultiIndex):
-            benchmark_adj_close = benchmark_data['Adj Close']
-        else:
-            benchmark_adj_close = benchmark_data['Adj Close']
-        
-        benchmark_returns = np.log(benchmark_adj_close).diff()
-        benchmark_returns.columns = [f'{request.benchmark_ticker.lower()}_return']
-        
-        # Combinar con benchmark
-        combined_performance = portfolio_df.merge(
-            benchmark_returns, left_index=True, right_index=True, how='left'
-        )
-        
-        # Calcular métricas
-        portfolio_returns = combined_performance['portfolio_return'].dropna()
-        benchmark_rets = combined_performance[f'{request.benchmark_ticker.lower()}_return'].dropna()
-        
-        # Retornos acumulativos
-        portfolio_cumulative = np.exp(np.log1p(portfolio_returns).cumsum()).sub(1)
-        benchmark_cumulative = np.exp(np.log1p(benchmark_rets).cumsum()).sub(1)
-        
-        # Métricas
-        total_portfolio_return = portfolio_cumulative.iloc[-1] if len(portfolio_cumulative) > 0 else 0
-        total_benchmark_return = benchmark_cumulative.iloc[-1] if len(benchmark_cumulative) > 0 else 0
-        
-        portfolio_volatility = portfolio_returns.std() * np.sqrt(252)
-        benchmark_volatility = benchmark_rets.std() * np.sqrt(252)
-        
-        sharpe_ratio = (portfolio_returns.mean() * 252) / portfolio_volatility if portfolio_volatility > 0 else 0
-        
-        processing_time = time.time() - start_time
-        
-        result = {
-            "status": "success",
-            "processing_time_seconds": processing_time,
-            "analysis": {
-                "total_portfolio_return": float(total_portfolio_return),
-                "total_benchmark_return": float(total_benchmark_return),
-                "excess_return": float(total_portfolio_return - total_benchmark_return),
-                "portfolio_volatility": float(portfolio_volatility),
-                "benchmark_volatility": float(benchmark_volatility),
-                "sharpe_ratio": float(sharpe_ratio),
-                "number_of_periods": len(portfolio_dates),
-                "unique_stocks_analyzed": len(unique_stocks)
-            },
-            "performance_data": {
-                "dates": portfolio_cumulative.index.strftime('%Y-%m-%d').tolist(),
-                "portfolio_cumulative_returns": portfolio_cumulative.values.tolist(),
-                "benchmark_cumulative_returns": benchmark_cumulative.values.tolist()
-            },
-            "portfolio_composition": portfolio_dates,
-            "metadata": {
-                "request_params": request.dict(),
-                "timestamp": datetime.now().isoformat(),
-                "api_version": "simplified_no_ray"
-            }
-        }
-        
-        # Guardar en cache
-        cache[cache_key] = result
-        
-        logger.info(f"Análisis completado en {processing_time:.2f} segundos")
-        return result
+        return ORJSONResponse(apply_encoding(result, encoding))
         
     except Exception as e:
         logger.error(f"Error en análisis de portafolio: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Aciertos, fallos y ocupación de los caches"""
+    return {
+        "results": _result_cache_stats(),
+        "stages": stage_store.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
 @app.delete("/cache/clear")
 async def clear_cache():
     """Limpiar cache"""
     global cache
     cache_size = len(cache)
     cache.clear()
+    stage_store.clear()
+    _clear_sentiment_disk()
     return {
         "status": "success",
         "message": f"Cache limpiado. {cache_size} entradas eliminadas.",
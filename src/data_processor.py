@@ -6,14 +6,32 @@ import ray
 import pandas as pd
 import numpy as np
 import yfinance as yf
+import os
+import threading
 import time
 from typing import List, Dict, Tuple
 import logging
+from collections import OrderedDict
+
+from _kernels import log_diff
+from membership import portfolio_returns_from_mask
+from yahoo import SESSION
+
+try:
+    import diskcache
+except ImportError:  # Cache en disco opcional
+    diskcache = None
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Cache persistente de descargas (CSV de sentimiento y precios); sobrevive a reinicios de réplicas
+CACHE_DIR = os.environ.get("PORTFOLIO_CACHE_DIR", ".portfolio_cache")
+CACHE_TTL_SECONDS = 24 * 3600
+LOCAL_DATES_THRESHOLD = 32
+MAX_BENCHMARK_ENTRIES = 64
+
 # Inicializar Ray si no está inicializado
 if not ray.is_initialized():
     ray.init()
@@ -33,28 +51,28 @@ class SentimentProcessor:
         self.sentiment_df = pd.read_csv(url)
         self.sentiment_df['date'] = pd.to_datetime(self.sentiment_df['date'])
         self.sentiment_df = self.sentiment_df.set_index(['date', 'symbol'])
-        self.sentiment_df['engagement_ratio'] = (
-            self.sentiment_df['twitterComments'] / self.sentiment_df['twitterLikes']
+        # Filtrar datos con suficiente engagement y calcular el ratio solo sobre
+        # las filas que quedan, en una pasada sobre los arrays
+        likes = self.sentiment_df['twitterLikes'].to_numpy()
+        comments = self.sentiment_df['twitterComments'].to_numpy()
+        mask = (likes > 20) & (comments > 10)
+        self.sentiment_df = self.sentiment_df.loc[mask].assign(
+            engagement_ratio=np.divide(comments[mask], likes[mask], dtype=np.float64)
         )
-        # Filtrar datos con suficiente engagement
-        self.sentiment_df = self.sentiment_df[
-            (self.sentiment_df['twitterLikes'] > 20) & 
-            (self.sentiment_df['twitterComments'] > 10)
-        ]
         return True
         
     def aggregate_sentiment(self):
         """Agregar datos por mes y símbolo"""
         logger.info("Agregando datos de sentimiento...")
+        months = self.sentiment_df.index.get_level_values('date').to_period('M')
         self.aggregated_df = (
-            self.sentiment_df.reset_index('symbol')
-            .groupby([pd.Grouper(freq='M'), 'symbol'])
+            self.sentiment_df.groupby([months, 'symbol'])
             [['engagement_ratio']].mean()
         )
-        # Ranking por mes
+        # Ranking por mes vectorizado (sin lambda por grupo)
         self.aggregated_df['rank'] = (
             self.aggregated_df.groupby(level=0)['engagement_ratio']
-            .transform(lambda x: x.rank(ascending=False))
+            .rank(ascending=False)
         )
         return True
         
@@ -63,24 +81,23 @@ class SentimentProcessor:
         logger.info(f"Filtrando top {top_n} stocks...")
         self.filtered_df = self.aggregated_df[self.aggregated_df['rank'] < (top_n + 1)].copy()
         self.filtered_df = self.filtered_df.reset_index(level=1)
-        self.filtered_df.index = self.filtered_df.index + pd.DateOffset(1)
+        # Primer día del mes siguiente al periodo agregado
+        self.filtered_df.index = (self.filtered_df.index + 1).to_timestamp()
         self.filtered_df = self.filtered_df.reset_index().set_index(['date', 'symbol'])
         return True
         
     def get_portfolio_dates(self) -> Dict[str, List[str]]:
         """Obtener fechas del portafolio"""
-        dates = self.filtered_df.index.get_level_values('date').unique().tolist()
-        fixed_dates = {}
-        for d in dates:
-            fixed_dates[d.strftime('%Y-%m-%d')] = (
-                self.filtered_df.xs(d, level=0).index.tolist()
-            )
-        return fixed_dates
+        # Una sola pasada con groupby en lugar de un xs por fecha
+        return {
+            d.strftime('%Y-%m-%d'): grp.index.get_level_values('symbol').tolist()
+            for d, grp in self.filtered_df.groupby(level=0, sort=False)
+        }
 
 @ray.remote
 def download_stock_batch(tickers: List[str], start_date: str, end_date: str, 
                         auto_adjust: bool = False) -> pd.DataFrame:
-    """Función remota para descargar un lote de acciones"""
+    """Función remota para descargar un lote de acciones (solo Adj Close, un ticker por columna)"""
     try:
         logger.info(f"Descargando lote: {tickers[:3]}... ({len(tickers)} tickers)")
         data = yf.download(
@@ -88,9 +105,15 @@ def download_stock_batch(tickers: List[str], start_date: str, end_date: str,
             start=start_date, 
             end=end_date,
             auto_adjust=auto_adjust, 
-            progress=False
+            progress=False,
+            session=SESSION
         )
-        return data
+        if data.empty:
+            return data
+        
+        # Descartar OHLCV de inmediato; un solo ticker devuelve una Series
+        adj_close = data['Close' if auto_adjust else 'Adj Close']
+        return adj_close.to_frame(tickers[0]) if isinstance(adj_close, pd.Series) else adj_close
     except Exception as e:
         logger.error(f"Error descargando lote {tickers}: {str(e)}")
         return pd.DataFrame()
@@ -107,54 +130,67 @@ def calculate_returns_batch(prices_batch: pd.DataFrame) -> pd.DataFrame:
         else:
             adj_close = prices_batch['Adj Close'] if 'Adj Close' in prices_batch.columns else prices_batch
             
-        returns = np.log(adj_close).diff().dropna()
+        # Log-retornos sobre el ndarray (sin DataFrames intermedios de log y diff).
+        # Se guardan en float32: la media/desviación de retornos diarios (~1e-3) es
+        # significativa a ~6 dígitos, dentro de la mantisa de ~7 dígitos de float32,
+        # y se mueve la mitad de bytes hacia las tareas de portafolio
+        returns = pd.DataFrame(
+            log_diff(adj_close.to_numpy(dtype=np.float64)).astype(np.float32, copy=False),
+            index=adj_close.index[1:],
+            columns=adj_close.columns
+        ).dropna()
         return returns
     except Exception as e:
         logger.error(f"Error calculando retornos: {str(e)}")
         return pd.DataFrame()
 
-@ray.remote
-def calculate_portfolio_returns_batch(returns_df: pd.DataFrame, 
-                                    portfolio_dates: Dict[str, List[str]],
-                                    date_batch: List[str]) -> pd.DataFrame:
+def portfolio_returns_for_dates(returns_df: pd.DataFrame, 
+                                portfolio_dates: Dict[str, List[str]],
+                                date_batch: List[str]) -> pd.DataFrame:
     """Calcular retornos del portafolio para un lote de fechas"""
-    portfolio_batch = pd.DataFrame()
+    batch_dates = {d: portfolio_dates[d] for d in date_batch if d in portfolio_dates}
+    if not batch_dates:
+        return pd.DataFrame()
     
-    for start_date in date_batch:
-        if start_date not in portfolio_dates:
-            continue
-            
-        end_date = (pd.to_datetime(start_date) + pd.offsets.MonthEnd()).strftime('%Y-%m-%d')
-        cols = portfolio_dates[start_date]
-        valid_cols = [c for c in cols if c in returns_df.columns]
-        
-        if valid_cols:
-            temp_df = (returns_df.loc[start_date:end_date, valid_cols]
-                      .mean(axis=1).to_frame('portfolio_return'))
-            portfolio_batch = pd.concat([portfolio_batch, temp_df])
-            
-    return portfolio_batch
+    # Los días de meses fuera del lote no tienen miembros y se descartan
+    return portfolio_returns_from_mask(returns_df, batch_dates)
+
+# Versión remota; Ray resuelve las ObjectRef de los argumentos en cada worker
+calculate_portfolio_returns_batch = ray.remote(portfolio_returns_for_dates)
 
 class ParallelPortfolioEngine:
     """Motor principal para el procesamiento paralelo del portafolio"""
     
     def __init__(self, batch_size: int = 20):
         self.batch_size = batch_size
-        self.sentiment_processor = None
+        self._disk_cache = diskcache.Cache(CACHE_DIR) if diskcache is not None else None
+        # Benchmark memoizado por (ticker, inicio, fin) en un LRU acotado
+        self._benchmark_cache = OrderedDict()
+        # Se usa desde hilos de run_in_executor / to_thread
+        self._benchmark_lock = threading.Lock()
         
     async def process_sentiment_data(self, url: str):
         """Procesar datos de sentimiento de forma paralela"""
         start_time = time.time()
         
-        # Crear procesador de sentimiento
-        self.sentiment_processor = SentimentProcessor.remote()
+        cache_key = ("sentiment", url)
+        cached = self._disk_cache.get(cache_key) if self._disk_cache is not None else None
+        if cached is not None:
+            logger.info("Datos de sentimiento obtenidos del cache en disco")
+            return cached
+        
+        # Actor propio de esta llamada: las peticiones concurrentes no comparten procesador
+        processor = SentimentProcessor.remote()
         
         # Procesar en paralelo
-        await self.sentiment_processor.load_sentiment_data.remote(url)
-        await self.sentiment_processor.aggregate_sentiment.remote()
-        await self.sentiment_processor.filter_top_stocks.remote()
+        await processor.load_sentiment_data.remote(url)
+        await processor.aggregate_sentiment.remote()
+        await processor.filter_top_stocks.remote()
+        
+        portfolio_dates = await processor.get_portfolio_dates.remote()
         
-        portfolio_dates = await self.sentiment_processor.get_portfolio_dates.remote()
+        if self._disk_cache is not None:
+            self._disk_cache.set(cache_key, portfolio_dates, expire=CACHE_TTL_SECONDS)
         
         logger.info(f"Procesamiento de sentimiento completado en {time.time() - start_time:.2f}s")
         return portfolio_dates
@@ -163,15 +199,24 @@ class ParallelPortfolioEngine:
         """Procesar datos de sentimiento de forma paralela (versión síncrona)"""
         start_time = time.time()
         
-        # Crear procesador de sentimiento
-        self.sentiment_processor = SentimentProcessor.remote()
+        cache_key = ("sentiment", url)
+        cached = self._disk_cache.get(cache_key) if self._disk_cache is not None else None
+        if cached is not None:
+            logger.info("Datos de sentimiento obtenidos del cache en disco")
+            return cached
+        
+        # Actor propio de esta llamada: las peticiones concurrentes no comparten procesador
+        processor = SentimentProcessor.remote()
         
         # Procesar en paralelo usando ray.get()
-        ray.get(self.sentiment_processor.load_sentiment_data.remote(url))
-        ray.get(self.sentiment_processor.aggregate_sentiment.remote())
-        ray.get(self.sentiment_processor.filter_top_stocks.remote())
+        ray.get(processor.load_sentiment_data.remote(url))
+        ray.get(processor.aggregate_sentiment.remote())
+        ray.get(processor.filter_top_stocks.remote())
+        
+        portfolio_dates = ray.get(processor.get_portfolio_dates.remote())
         
-        portfolio_dates = ray.get(self.sentiment_processor.get_portfolio_dates.remote())
+        if self._disk_cache is not None:
+            self._disk_cache.set(cache_key, portfolio_dates, expire=CACHE_TTL_SECONDS)
         
         logger.info(f"Procesamiento de sentimiento completado en {time.time() - start_time:.2f}s")
         return portfolio_dates
@@ -182,9 +227,12 @@ class ParallelPortfolioEngine:
         """Descargar datos de acciones en paralelo"""
         start_time = time.time()
         
-        # Excluir acciones problemáticas
-        excluded = ['MRO', 'ATVI']
-        stocks_list = [s for s in stocks_list if s not in excluded]
+        # La clave no depende del orden de los símbolos
+        cache_key = ("prices", tuple(sorted(stocks_list)), start_date, end_date)
+        cached = self._disk_cache.get(cache_key) if self._disk_cache is not None else None
+        if cached is not None:
+            logger.info("Precios obtenidos del cache en disco")
+            return cached
         
         # Dividir en lotes
         batches = [stocks_list[i:i + self.batch_size] 
@@ -204,6 +252,10 @@ class ParallelPortfolioEngine:
         
         if valid_dataframes:
             combined_df = pd.concat(valid_dataframes, axis=1)
+            # Solo descargas completas: un fallo transitorio no debe fijar precios parciales 24h
+            complete = combined_df.columns.intersection(stocks_list).size == len(set(stocks_list))
+            if self._disk_cache is not None and complete:
+                self._disk_cache.set(cache_key, combined_df, expire=CACHE_TTL_SECONDS)
             logger.info(f"Descarga completada en {time.time() - start_time:.2f}s")
             return combined_df
         else:
@@ -219,13 +271,22 @@ class ParallelPortfolioEngine:
         returns_future = calculate_returns_batch.remote(prices_df)
         returns_df = ray.get(returns_future)
         
-        # Dividir fechas en lotes para procesamiento paralelo
         date_list = list(portfolio_dates.keys())
+        
+        # Con pocas fechas el coste de planificar tareas supera al cálculo
+        if len(date_list) < LOCAL_DATES_THRESHOLD:
+            portfolio_df = portfolio_returns_for_dates(returns_df, portfolio_dates, date_list)
+            logger.info(f"Cálculo de performance completado en {time.time() - start_time:.2f}s")
+            return portfolio_df
+        
+        # Dividir fechas en lotes para procesamiento paralelo
         date_batches = [date_list[i:i + 5] for i in range(0, len(date_list), 5)]
         
-        # Calcular retornos del portafolio en paralelo
+        # Publicar los datos una sola vez en el object store
+        returns_ref = ray.put(returns_df)
+        dates_ref = ray.put(portfolio_dates)
         portfolio_futures = [
-            calculate_portfolio_returns_batch.remote(returns_df, portfolio_dates, batch)
+            calculate_portfolio_returns_batch.remote(returns_ref, dates_ref, batch)
             for batch in date_batches
         ]
         
@@ -236,26 +297,46 @@ class ParallelPortfolioEngine:
         
         logger.info(f"Cálculo de performance completado en {time.time() - start_time:.2f}s")
         return portfolio_df
+    
+    def clear_caches(self):
+        """Vaciar el cache en disco (sentiment y precios) y el de benchmark"""
+        if self._disk_cache is not None:
+            self._disk_cache.clear()
+        with self._benchmark_lock:
+            self._benchmark_cache.clear()
         
     def get_benchmark_data(self, ticker: str = 'QQQ', 
                           start_date: str = '2021-01-01',
                           end_date: str = '2023-03-01') -> pd.DataFrame:
         """Obtener datos de benchmark"""
+        cache_key = (ticker, start_date, end_date)
+        with self._benchmark_lock:
+            if cache_key in self._benchmark_cache:
+                self._benchmark_cache.move_to_end(cache_key)
+                return self._benchmark_cache[cache_key]
+        
         benchmark_data = yf.download(
             tickers=ticker,
             start=start_date,
             end=end_date,
-            auto_adjust=False
+            auto_adjust=False,
+            session=SESSION
         )
         
-        if isinstance(benchmark_data.columns, pd.MultiIndex):
-            adj_close = benchmark_data['Adj Close']
-        else:
-            adj_close = benchmark_data['Adj Close']
-            
-        benchmark_returns = np.log(adj_close).diff()
-        benchmark_returns.columns = [f'{ticker.lower()}_return']
+        adj_close = benchmark_data['Adj Close']
+        if isinstance(adj_close, pd.DataFrame):
+            adj_close = adj_close.iloc[:, 0]
+        
+        # El primer día no tiene retorno; queda fuera al alinear con el portafolio
+        benchmark_returns = pd.DataFrame(
+            {f'{ticker.lower()}_return': log_diff(adj_close.to_numpy(dtype=np.float64))},
+            index=adj_close.index[1:]
+        )
         
+        with self._benchmark_lock:
+            self._benchmark_cache[cache_key] = benchmark_returns
+            if len(self._benchmark_cache) > MAX_BENCHMARK_ENTRIES:
+                self._benchmark_cache.popitem(last=False)
         return benchmark_returns
 
 def shutdown_ray():
@@ -0,0 +1,76 @@
+"""
+Retornos del portafolio a partir de la composición mensual (portfolio_dates)
+Compartido por data_processor.py y api_simple.py
+"""
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from _kernels import log_diff_monthly_mean
+
+@lru_cache(maxsize=128)
+def _membership_table(portfolio_items: Tuple[Tuple[str, Tuple[str, ...]], ...]
+                      ) -> Tuple[pd.PeriodIndex, pd.Index, np.ndarray]:
+    """Meses, símbolos y tabla bool (mes x símbolo) memoizados por composición del portafolio
+    
+    La tabla lleva una fila y una columna extra en False: las posiciones -1 de
+    get_indexer (mes o símbolo fuera del portafolio) caen ahí sin tratarlas aparte.
+    """
+    dates = [d for d, stocks in portfolio_items for _ in stocks]
+    symbols = np.array([s for _, stocks in portfolio_items for s in stocks], dtype=object)
+    month_codes, months = pd.to_datetime(dates).to_period('M').factorize()
+    symbol_codes, symbol_uniques = pd.factorize(symbols)
+    
+    table = np.zeros((len(months) + 1, len(symbol_uniques) + 1), dtype=bool)
+    table[month_codes, symbol_codes] = True
+    table.flags.writeable = False
+    return months, pd.Index(symbol_uniques), table
+
+def month_membership(portfolio_dates: Dict[str, List[str]],
+                     months: pd.PeriodIndex, columns: pd.Index) -> np.ndarray:
+    """Tabla (meses x columnas): True si el stock está en el portafolio de ese mes"""
+    # Las fechas se parsean y factorizan una sola vez por composición (requests y lotes repetidos)
+    portfolio_items = tuple((d, tuple(stocks)) for d, stocks in portfolio_dates.items())
+    table_months, table_symbols, table = _membership_table(portfolio_items)
+    
+    # Posiciones precalculadas de filas y columnas: un solo gather, sin alinear etiquetas.
+    # La indexación avanzada devuelve una copia: la tabla cacheada no se modifica
+    row_pos = table_months.get_indexer(months)
+    col_pos = table_symbols.get_indexer(columns)
+    return table[np.ix_(row_pos, col_pos)]
+
+def membership_mask(portfolio_dates: Dict[str, List[str]],
+                    index: pd.DatetimeIndex, columns: pd.Index) -> np.ndarray:
+    """Máscara (filas x columnas): True si el stock está en el portafolio del mes de la fila"""
+    return month_membership(portfolio_dates, index.to_period('M'), columns)
+
+def portfolio_returns_from_mask(returns_df: pd.DataFrame,
+                                portfolio_dates: Dict[str, List[str]]) -> pd.DataFrame:
+    """Retorno diario equiponderado de los stocks del portafolio de cada mes, en una sola pasada"""
+    # Se conserva el dtype de los retornos (float32 en el pipeline Ray)
+    values = returns_df.to_numpy()
+    mask = membership_mask(portfolio_dates, returns_df.index, returns_df.columns)
+    # Igual que mean(skipna=True): los NaN no cuentan como miembros
+    mask &= ~np.isnan(values)
+    
+    counts = mask.sum(axis=1)
+    totals = np.where(mask, values, 0.0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # counts es entero: la división promueve a float64, se vuelve al dtype de entrada
+        portfolio_return = (totals / counts).astype(values.dtype, copy=False)
+    
+    # Días fuera de cualquier portafolio (o sin stocks válidos) quedan NaN y se descartan
+    return (pd.Series(portfolio_return, index=returns_df.index)
+            .dropna().to_frame('portfolio_return'))
+
+def portfolio_returns_from_prices(prices_df: pd.DataFrame,
+                                  portfolio_dates: Dict[str, List[str]]) -> pd.DataFrame:
+    """Retornos del portafolio directamente desde precios: log, diff y media mensual fusionados"""
+    month_id, months = prices_df.index.to_period('M').factorize()
+    col_in_month = month_membership(portfolio_dates, months, prices_df.columns)
+    prices = np.ascontiguousarray(prices_df.to_numpy(dtype=np.float64))
+    
+    portfolio_return = log_diff_monthly_mean(prices, month_id.astype(np.int64), col_in_month)
+    return (pd.Series(portfolio_return, index=prices_df.index)
+            .dropna().to_frame('portfolio_return'))
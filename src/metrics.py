@@ -0,0 +1,69 @@
+"""
+Métricas de performance del portafolio compartidas por main.py y la API
+Kernel compilado con numba: retorno acumulado, volatilidad y Sharpe en una sola pasada.
+"""
+import math
+import numpy as np
+from typing import Tuple
+
+try:
+    from numba import njit
+except ImportError:  # Sin numba se usa la versión vectorizada con NumPy
+    njit = None
+
+# Días de trading por año y tasa libre de riesgo anual
+TRADING_DAYS = 252
+SQRT_TRADING_DAYS = math.sqrt(TRADING_DAYS)
+RISK_FREE_RATE = 0.02
+
+def _metrics_loop(r: np.ndarray, rf_d: float):
+    """Recorrer los retornos una vez acumulando producto, suma y suma de cuadrados"""
+    n = r.size
+    cum = np.empty(n)
+    acc = 1.0
+    s = 0.0
+    s2 = 0.0
+    for i in range(n):
+        acc *= 1.0 + r[i]
+        cum[i] = acc - 1.0
+        e = r[i] - rf_d
+        s += e
+        s2 += e * e
+    
+    mu = s / n
+    # Varianza muestral (ddof=1), igual que pandas .std()
+    var = (s2 - n * mu * mu) / (n - 1)
+    sigma = np.sqrt(var) if var > 0.0 else 0.0
+    volatility = sigma * SQRT_TRADING_DAYS
+    sharpe = mu / sigma * SQRT_TRADING_DAYS if sigma > 0.0 else 0.0
+    return cum, acc - 1.0, volatility, sharpe
+
+def _metrics_numpy(r: np.ndarray, rf_d: float):
+    """Equivalente vectorizado de _metrics_loop"""
+    cum = np.cumprod(1.0 + r) - 1.0
+    excess = r - rf_d
+    sigma = excess.std(ddof=1)
+    volatility = sigma * SQRT_TRADING_DAYS if sigma > 0.0 else 0.0
+    sharpe = excess.mean() / sigma * SQRT_TRADING_DAYS if sigma > 0.0 else 0.0
+    return cum, cum[-1], volatility, sharpe
+
+_metrics = njit(cache=True, fastmath=True)(_metrics_loop) if njit is not None else _metrics_numpy
+
+def compute_metrics(returns: np.ndarray,
+                    risk_free_rate: float = RISK_FREE_RATE) -> Tuple[np.ndarray, float, float, float]:
+    """Calcular (retornos acumulados, retorno total, volatilidad anual, Sharpe) de retornos diarios
+    
+    Kernel compartido por main.py, api.py y api_simple.py: una sola pasada sobre el array,
+    con el Sharpe sobre el exceso a la tasa libre de riesgo. Los llamadores alinean antes el
+    benchmark al índice del portafolio con reindex, sin join intermedio.
+    """
+    r = np.ascontiguousarray(returns, dtype=np.float64)
+    
+    # Con menos de dos observaciones no hay dispersión que medir
+    if r.size < 2:
+        cum = np.cumprod(1.0 + r) - 1.0
+        return cum, float(cum[-1]) if r.size else 0.0, 0.0, 0.0
+    
+    rf_d = (1 + risk_free_rate) ** (1 / TRADING_DAYS) - 1
+    cum, total, volatility, sharpe = _metrics(r, rf_d)
+    return cum, float(total), float(volatility), float(sharpe)
@@ -0,0 +1,30 @@
+"""
+Codificación compacta de series numéricas para las respuestas de la API
+"""
+import base64
+import numpy as np
+from typing import Dict, Optional
+
+# Deltas de primer orden en float32 little-endian, codificados en base64
+DELTA_F32 = "delta-f32"
+
+PERFORMANCE_SERIES = ("portfolio_cumulative_returns", "benchmark_cumulative_returns")
+
+def encode_delta_f32(values) -> str:
+    """Codificar una serie acumulada como deltas float32 en base64"""
+    arr = np.asarray(values, dtype=np.float64)
+    deltas = np.diff(arr, prepend=0.0).astype("<f4")
+    return base64.b64encode(deltas.tobytes()).decode("ascii")
+
+def apply_encoding(result: Dict, encoding: Optional[str]) -> Dict:
+    """Devolver el resultado con performance_data en la codificación solicitada"""
+    if encoding != DELTA_F32 or "performance_data" not in result:
+        return result
+    
+    performance_data = dict(result["performance_data"])
+    for key in PERFORMANCE_SERIES:
+        performance_data[key] = encode_delta_f32(performance_data[key])
+    performance_data["encoding"] = DELTA_F32
+    
+    # Copia superficial: el resultado cacheado conserva los arrays originales
+    return {**result, "performance_data": performance_data}
@@ -0,0 +1,52 @@
+"""
+Acceso a Yahoo Finance: sesión HTTP, filtro de tickers y endpoint chart
+Compartido por data_processor.py (Ray) y api_simple.py
+"""
+import re
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional
+
+CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+
+# Sesión HTTP compartida por todas las descargas del proceso (yfinance): las
+# conexiones keep-alive evitan un handshake TCP+TLS por lote
+HTTP_POOL_SIZE = 32
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+SESSION.headers["User-Agent"] = "Mozilla/5.0"
+
+# Tickers problemáticos y formato aceptado por Yahoo (se descartan antes de pedir nada)
+EXCLUDED_TICKERS = frozenset({'MRO', 'ATVI'})
+_TICKER_RE = re.compile(r'^[A-Z][A-Z0-9.\-]{0,6}$')
+
+def filter_tickers(symbols: List[str]) -> List[str]:
+    """Quitar tickers excluidos o mal formados, que solo costarían un round-trip vacío"""
+    return [s for s in symbols if s not in EXCLUDED_TICKERS and _TICKER_RE.fullmatch(s)]
+
+def chart_params(start_date: str, end_date: str) -> Dict:
+    """Parámetros de query para un request de chart con cierre ajustado"""
+    return {
+        "period1": int(pd.Timestamp(start_date).timestamp()),
+        "period2": int(pd.Timestamp(end_date).timestamp()),
+        "interval": "1d",
+        "includeAdjustedClose": "true"
+    }
+
+def parse_chart(payload: Dict, symbol: str) -> Optional[pd.Series]:
+    """Adj Close diario de una respuesta de chart (None si no trae cierre ajustado)
+    
+    Solo se usa el cierre ajustado: el cierre sin ajustar produciría retornos
+    falsos en splits, así que el llamador descarga esos símbolos por otra vía.
+    """
+    result = (payload.get("chart", {}).get("result") or [None])[0]
+    if not result or not result.get("timestamp"):
+        return None
+    adj_close = ((result.get("indicators") or {}).get("adjclose") or [{}])[0].get("adjclose")
+    if not adj_close:
+        return None
+    
+    index = pd.to_datetime(result["timestamp"], unit="s").normalize().rename("Date")
+    return pd.Series(adj_close, index=index, name=symbol, dtype=np.float64)